@@ -1,14 +1,122 @@
 import copy
+import functools
 import json
 import logging
+import time
 
-from tesselate.utils import layers_dict
+import numpy
+
+from tesselate import const
+from tesselate.utils import concurrent_map, layers_dict
 
 
 def aggregate(client, area, composite, formula, grouping='continuous', zoom=None, synchronous=True):
     """
     Request aggregation data.
     """
+    post_params, get_params = _aggregation_params(area, composite, formula, grouping, zoom)
+    # Try to get result from cache.
+    result = client.dispatch('valuecountresult', **get_params)
+    if len(result):
+        return result[0]
+    else:
+        # If valuecount has not been precomputed, do it now.
+        logging.info('Value count not precomputed, requesting {} calculation.'.format('synchronous' if synchronous else 'asynchronous'))
+        return client.post('valuecountresult{}'.format('?synchronous' if synchronous else ''), data=post_params)
+
+
+def aggregate_many(client, areas, composite, formula, grouping='continuous', zoom=None, workers=None, poll_interval=1, max_poll_interval=30, timeout=None):
+    """
+    Request aggregation data for many areas.
+
+    The cached results are looked up concurrently if workers is larger than
+    one. Missing results are requested asynchronously, and all results that
+    are not finished yet are polled with an exponentially growing interval
+    until they are done.
+
+    Returns a dict with the results keyed by area id. Areas whose computation
+    failed or did not finish within the timeout in seconds have None values.
+    """
+    area_ids = [area['id'] if isinstance(area, dict) else area for area in areas]
+
+    # Look up cached results.
+    lookup = functools.partial(_lookup_valuecount, client, composite=composite, formula=formula, grouping=grouping, zoom=zoom)
+    results = dict(concurrent_map(lookup, area_ids, workers=workers))
+
+    # Request the missing results asynchronously.
+    missing = [area_id for area_id, result in results.items() if result is None]
+    logging.info('Found {} cached value counts, requesting {} asynchronous calculations.'.format(len(results) - len(missing), len(missing)))
+    submit = functools.partial(_submit_valuecount, client, composite=composite, formula=formula, grouping=grouping, zoom=zoom)
+    results.update(concurrent_map(submit, missing, workers=workers))
+
+    # Poll unfinished results until they are done.
+    start = time.time()
+    interval = poll_interval
+    while True:
+        pending = _pending_valuecounts(results)
+        if not pending:
+            break
+        if timeout is not None and time.time() - start + interval > timeout:
+            _expire_valuecounts(results, pending, timeout)
+            break
+        logging.info('Waiting {} seconds for {} value counts.'.format(interval, len(pending)))
+        time.sleep(interval)
+        interval = min(max_poll_interval, 2 * interval)
+        results.update(concurrent_map(lambda area_id: _refresh_valuecount(client, area_id, results[area_id]), pending, workers=workers))
+
+    return results
+
+
+def _lookup_valuecount(client, area_id, composite, formula, grouping, zoom):
+    """
+    Get the cached value count result of an area, or None if it does not exist.
+    """
+    post_params, get_params = _aggregation_params({'id': area_id}, composite, formula, grouping, zoom)
+    result = client.dispatch('valuecountresult', **get_params)
+    return area_id, result[0] if len(result) else None
+
+
+def _submit_valuecount(client, area_id, composite, formula, grouping, zoom):
+    """
+    Request the asynchronous computation of a value count result.
+    """
+    post_params, get_params = _aggregation_params({'id': area_id}, composite, formula, grouping, zoom)
+    return area_id, client.post('valuecountresult', data=post_params)
+
+
+def _refresh_valuecount(client, area_id, result):
+    """
+    Get the current state of a value count result.
+    """
+    return area_id, client.dispatch('valuecountresult', id=result['id'])
+
+
+def _pending_valuecounts(results):
+    """
+    Replace failed value count results with None, and list the areas whose
+    results are not finished yet.
+    """
+    for area_id, result in results.items():
+        if result and result.get('status') == const.VALUECOUNT_FAILED:
+            logging.warning('Value count for area {} failed.'.format(area_id))
+            results[area_id] = None
+    # Results without status were computed synchronously.
+    return [area_id for area_id, result in results.items() if result and result.get('status', const.VALUECOUNT_FINISHED) != const.VALUECOUNT_FINISHED]
+
+
+def _expire_valuecounts(results, pending, timeout):
+    """
+    Replace the results that did not finish within the timeout with None.
+    """
+    logging.warning('Value counts for {} areas did not finish within {} seconds.'.format(len(pending), timeout))
+    for area_id in pending:
+        results[area_id] = None
+
+
+def _aggregation_params(area, composite, formula, grouping, zoom):
+    """
+    Construct the POST and GET query parameters for a value count request.
+    """
     # Get layer names for request.
     layer_names = layers_dict(composite, formula)
     # Grouping parameter needs to be a string.
@@ -29,40 +137,137 @@ def aggregate(client, area, composite, formula, grouping='continuous', zoom=None
     # contained in the url query parameters.
     get_params = copy.deepcopy(post_params)
     get_params['layer_names'] = json.dumps(layer_names)
-    # Try to get result from cache.
-    result = client.dispatch('valuecountresult', **get_params)
-    if len(result):
-        return result[0]
-    else:
-        # If valuecount has not been precomputed, do it now.
-        logging.info('Value count not precomputed, requesting {} calculation.'.format('synchronous' if synchronous else 'asynchronous'))
-        return client.post('valuecountresult{}'.format('?synchronous' if synchronous else ''), data=post_params)
+
+    return post_params, get_params
 
 
 def regional_aggregate(valuecounts):
     """
     Use the cumsum and sq_cumsum from valuecounts to compute regional stats.
     """
-    # Compute sum of sums.
-    stats_t0 = sum([dat['pcount'] for dat in valuecounts])
-    stats_t1 = sum([dat['psum'] for dat in valuecounts])
-    stats_t2 = sum([dat['psumsq'] for dat in valuecounts])
-    # Get total min and max values.
-    stats_min = min([dat['min'] for dat in valuecounts])
-    stats_max = min([dat['max'] for dat in valuecounts])
-    # Compute regional mean and std.
-    if stats_t0 == 0:
-        # If totals sum is zero, no data was available to comput statistics
-        mean = None
-        std = None
-    else:
-        # Compute mean and std from totals sums.
-        mean = stats_t1 / stats_t0
-        std = (stats_t0 * stats_t2 - stats_t1 * stats_t1) ** 0.5 / stats_t0
-
-    return {
-        'min': stats_min,
-        'max': stats_max,
-        'std': std,
-        'mean': mean,
-    }
+    stats = RegionalStats()
+    stats.update(valuecounts)
+    return stats.result()
+
+
+class RegionalStats(object):
+    """
+    Accumulator for regional statistics over value count results.
+
+    The count, mean, sum of squared deviations, min and max are kept in numpy
+    arrays with one entry per group. Partial statistics are combined with the
+    parallel variance formula, so accumulators from several workers can be
+    merged without loss of precision.
+    """
+
+    def __init__(self):
+        self.groups = []
+        self._index = {}
+        self.count = numpy.zeros(0)
+        self.mean = numpy.zeros(0)
+        self.m2 = numpy.zeros(0)
+        self.min = numpy.zeros(0)
+        self.max = numpy.zeros(0)
+
+    def update(self, valuecounts, groups=None):
+        """
+        Add value count results. The optional groups are the group keys of the
+        value counts, for instance the parent region of each area.
+        """
+        valuecounts = list(valuecounts)
+        if groups is None:
+            groups = [None] * len(valuecounts)
+        elif len(groups) != len(valuecounts):
+            raise ValueError('Provide one group key for every value count.')
+        # Skip missing results and value counts without data.
+        entries = [(dat, group) for dat, group in zip(valuecounts, groups) if dat and dat.get('pcount')]
+        if not entries:
+            return
+        valuecounts, groups = zip(*entries)
+
+        # Statistics of the individual value counts.
+        count = numpy.array([dat['pcount'] for dat in valuecounts], dtype='float64')
+        mean = numpy.array([dat['psum'] for dat in valuecounts], dtype='float64') / count
+        sumsq = numpy.array([dat['psumsq'] for dat in valuecounts], dtype='float64')
+        m2 = numpy.maximum(sumsq - count * mean * mean, 0)
+        minimum = numpy.array([numpy.nan if dat['min'] is None else dat['min'] for dat in valuecounts], dtype='float64')
+        maximum = numpy.array([numpy.nan if dat['max'] is None else dat['max'] for dat in valuecounts], dtype='float64')
+
+        # Reduce the value counts per group in one pass.
+        keys, inverse = _unique(groups)
+        group_count = numpy.bincount(inverse, count, len(keys))
+        group_mean = numpy.bincount(inverse, count * mean, len(keys)) / group_count
+        group_m2 = numpy.bincount(inverse, m2 + count * (mean - group_mean[inverse]) ** 2, len(keys))
+        group_min = numpy.full(len(keys), numpy.nan)
+        numpy.fmin.at(group_min, inverse, minimum)
+        group_max = numpy.full(len(keys), numpy.nan)
+        numpy.fmax.at(group_max, inverse, maximum)
+
+        self._combine(keys, group_count, group_mean, group_m2, group_min, group_max)
+
+    def merge(self, other):
+        """
+        Add the statistics of another accumulator.
+        """
+        self._combine(other.groups, other.count, other.mean, other.m2, other.min, other.max)
+        return self
+
+    def _combine(self, keys, count, mean, m2, minimum, maximum):
+        # Add new groups.
+        new = [key for key in keys if key not in self._index]
+        for key in new:
+            self._index[key] = len(self.groups)
+            self.groups.append(key)
+        if new:
+            self.count = numpy.concatenate([self.count, numpy.zeros(len(new))])
+            self.mean = numpy.concatenate([self.mean, numpy.zeros(len(new))])
+            self.m2 = numpy.concatenate([self.m2, numpy.zeros(len(new))])
+            self.min = numpy.concatenate([self.min, numpy.full(len(new), numpy.nan)])
+            self.max = numpy.concatenate([self.max, numpy.full(len(new), numpy.nan)])
+
+        # Combine with the parallel variance formula.
+        index = numpy.array([self._index[key] for key in keys], dtype='int64')
+        total = self.count[index] + count
+        delta = mean - self.mean[index]
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            self.mean[index] = numpy.where(total > 0, self.mean[index] + delta * count / total, 0)
+            self.m2[index] += numpy.where(total > 0, m2 + delta ** 2 * self.count[index] * count / total, 0)
+        self.count[index] = total
+        self.min[index] = numpy.fmin(self.min[index], minimum)
+        self.max[index] = numpy.fmax(self.max[index], maximum)
+
+    def result(self, group=None):
+        """
+        Get the min, max, mean and standard deviation of a group.
+        """
+        if group not in self._index:
+            return {'min': None, 'max': None, 'std': None, 'mean': None}
+        index = self._index[group]
+        if self.count[index] == 0:
+            mean = None
+            std = None
+        else:
+            mean = float(self.mean[index])
+            std = float(numpy.sqrt(self.m2[index] / self.count[index]))
+        return {
+            'min': None if numpy.isnan(self.min[index]) else float(self.min[index]),
+            'max': None if numpy.isnan(self.max[index]) else float(self.max[index]),
+            'std': std,
+            'mean': mean,
+        }
+
+    def results(self):
+        """
+        Get the statistics of all groups, keyed by group.
+        """
+        return {group: self.result(group) for group in self.groups}
+
+
+def _unique(groups):
+    """
+    Get the unique group keys in order of appearance, and the index of the
+    key of every input.
+    """
+    index = {}
+    inverse = numpy.array([index.setdefault(group, len(index)) for group in groups], dtype='int64')
+    return list(index), inverse
@@ -0,0 +1,242 @@
+import asyncio
+import functools
+import itertools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+from tesselate import aggregation, tiles
+from tesselate.client import Client
+from tesselate.export import _decoder, _fetch_tile, _finish_export, _setup_export, _work_path, _write_tile
+
+
+class AsyncClient(object):
+    """
+    Asyncio interface to the api.
+
+    The requests are sent through the pooled session of a regular client in a
+    thread pool, so that any number of requests can be awaited on one event
+    loop. The concurrency is the maximum number of requests in flight.
+    """
+
+    def __init__(self, client=None, concurrency=10):
+        if client is None:
+            client = Client()
+            client.set_pool_options(pool_maxsize=concurrency)
+        self.client = client
+        self.concurrency = concurrency
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run a blocking function in the request thread pool.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def get(self, url, json_response=True):
+        return await self.run(self.client.get, url, json_response=json_response)
+
+    async def post(self, url, data={}):
+        return await self.run(self.client.post, url, data=data)
+
+    async def patch(self, url, data):
+        return await self.run(self.client.patch, url, data)
+
+    async def delete(self, url, force=False):
+        return await self.run(self.client.delete, url, force=force)
+
+    async def dispatch(self, endpoint, **kwargs):
+        """
+        Dispatch REST requests with the same arguments as the regular client.
+        Use iterate to get all pages of list queries.
+        """
+        if kwargs.get('all_pages', False):
+            raise ValueError('Use iterate to get all pages asynchronously.')
+        return await self.run(self.client.dispatch, endpoint, **kwargs)
+
+    async def iterate(self, endpoint, prefetch=True, batch_size=100, **kwargs):
+        """
+        Asynchronously iterate over all records of a list endpoint. The records
+        are pulled from the pages in batches of batch_size.
+        """
+        records = self.client.iterate(endpoint, prefetch=prefetch, **kwargs)
+        while True:
+            batch = await self.run(lambda: list(itertools.islice(records, batch_size)))
+            if not batch:
+                return
+            for record in batch:
+                yield record
+
+    def close(self):
+        self._executor.shutdown()
+
+
+async def algebra(aclient, tilez, tilex, tiley, composite, formula):
+    return await aclient.run(tiles.algebra, aclient.client, tilez, tilex, tiley, composite, formula)
+
+
+async def rgb(aclient, tilez, tilex, tiley, composite):
+    return await aclient.run(tiles.rgb, aclient.client, tilez, tilex, tiley, composite)
+
+
+async def aggregate(aclient, area, composite, formula, grouping='continuous', zoom=None, synchronous=True):
+    return await aclient.run(aggregation.aggregate, aclient.client, area, composite, formula, grouping, zoom, synchronous)
+
+
+async def aggregate_many(aclient, areas, composite, formula, grouping='continuous', zoom=None, poll_interval=1, max_poll_interval=30, timeout=None):
+    """
+    Asynchronous version of the aggregate_many function.
+
+    All requests are sent through the async client, and the event loop is not
+    blocked while waiting for unfinished results.
+    """
+    loop = asyncio.get_running_loop()
+    area_ids = [area['id'] if isinstance(area, dict) else area for area in areas]
+
+    # Look up cached results.
+    results = dict(await asyncio.gather(*[
+        aclient.run(aggregation._lookup_valuecount, aclient.client, area_id, composite, formula, grouping, zoom) for area_id in area_ids
+    ]))
+
+    # Request the missing results asynchronously.
+    missing = [area_id for area_id, result in results.items() if result is None]
+    logging.info('Found {} cached value counts, requesting {} asynchronous calculations.'.format(len(results) - len(missing), len(missing)))
+    results.update(await asyncio.gather(*[
+        aclient.run(aggregation._submit_valuecount, aclient.client, area_id, composite, formula, grouping, zoom) for area_id in missing
+    ]))
+
+    # Poll unfinished results until they are done.
+    start = loop.time()
+    interval = poll_interval
+    while True:
+        pending = aggregation._pending_valuecounts(results)
+        if not pending:
+            break
+        if timeout is not None and loop.time() - start + interval > timeout:
+            aggregation._expire_valuecounts(results, pending, timeout)
+            break
+        logging.info('Waiting {} seconds for {} value counts.'.format(interval, len(pending)))
+        await asyncio.sleep(interval)
+        interval = min(max_poll_interval, 2 * interval)
+        results.update(await asyncio.gather(*[
+            aclient.run(aggregation._refresh_valuecount, aclient.client, area_id, results[area_id]) for area_id in pending
+        ]))
+
+    return results
+
+
+async def export(aclient, region, composite, formula, file_path=None, zoom=14, clip_to_geom=False, all_touched=False, sparse=False, cog=False, compress='deflate', predictor=None):
+    """
+    Asynchronous version of the export function.
+
+    Tiles are fetched concurrently through the async client. Decoding and
+    writing happens in a single separate thread, so that the event loop is
+    never blocked by raster operations.
+    """
+    if cog and not file_path:
+        raise ValueError('Cloud optimized exports require a file path.')
+
+    loop = asyncio.get_running_loop()
+    writer = ThreadPoolExecutor(max_workers=1)
+    try:
+        target, index_range, tile_indices, rgb, clip = await loop.run_in_executor(
+            writer, _setup_export, aclient.client, region, composite, formula, _work_path(file_path, cog), zoom, sparse, aclient.concurrency, compress, predictor, clip_to_geom, all_touched,
+        )
+        decode = _decoder(formula, rgb)
+
+        def write(tile, data):
+            data = decode(data)
+            if clip:
+                data = clip(tile, data)
+            _write_tile(data, tile[0], tile[1], index_range, target)
+
+        # Limit the number of fetched tiles waiting to be written.
+        pending = asyncio.Semaphore(2 * aclient.concurrency)
+        counter = itertools.count()
+
+        async def process(tile):
+            async with pending:
+                data = await aclient.run(_fetch_tile, aclient.client, zoom, tile[0], tile[1], composite, formula, rgb)
+                await loop.run_in_executor(writer, write, tile, data)
+            # Log progress.
+            index = next(counter)
+            if index % 100 == 0:
+                logging.info('Processed {}/{} tiles.'.format(index, len(tile_indices)))
+
+        tasks = [asyncio.ensure_future(process(tile)) for tile in tile_indices]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Stop the remaining tiles if one of them failed.
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        return await loop.run_in_executor(writer, _finish_export, target, file_path if cog else None, compress, predictor)
+    finally:
+        # Wait for running writes without blocking the event loop.
+        await loop.run_in_executor(None, writer.shutdown)
+
+
+class AsyncTesselate(object):
+    """
+    Asyncio version of the Tesselate interface.
+    """
+
+    def __init__(self, client=None, concurrency=10):
+        # For the raster tilesize function.
+        try:
+            settings.configure()
+        except:
+            pass
+
+        # instantiate the client.
+        self.client = AsyncClient(client, concurrency=concurrency)
+
+    async def region(self, id=None, **filters):
+        return await self.client.dispatch('aggregationlayer', id=id, **filters)
+
+    async def area(self, id=None, **filters):
+        return await self.client.dispatch('aggregationarea', id=id, **filters)
+
+    async def composite(self, id=None, **filters):
+        return await self.client.dispatch('composite', id=id, **filters)
+
+    async def compositebuild(self, id=None, **filters):
+        return await self.client.dispatch('compositebuild', id=id, **filters)
+
+    async def scene(self, id=None, **filters):
+        return await self.client.dispatch('sentineltile', id=id, **filters)
+
+    async def formula(self, id=None, **filters):
+        return await self.client.dispatch('formula', id=id, **filters)
+
+    async def trainingsample(self, id=None, **filters):
+        return await self.client.dispatch('trainingsample', id=id, **filters)
+
+    async def traininglayer(self, id=None, **filters):
+        return await self.client.dispatch('traininglayer', id=id, **filters)
+
+    async def classifier(self, id=None, **filters):
+        return await self.client.dispatch('classifier', id=id, **filters)
+
+    async def predictedlayer(self, id=None, **filters):
+        return await self.client.dispatch('predictedlayer', id=id, **filters)
+
+    async def algebra(self, tilez, tilex, tiley, composite, formula):
+        return await algebra(self.client, tilez, tilex, tiley, composite, formula)
+
+    async def rgb(self, tilez, tilex, tiley, composite):
+        return await rgb(self.client, tilez, tilex, tiley, composite)
+
+    async def export(self, region, composite, formula, file_path, zoom=14, clip_to_geom=False, all_touched=False, sparse=False, cog=False, compress='deflate', predictor=None):
+        return await export(self.client, region, composite, formula, file_path, zoom=zoom, clip_to_geom=clip_to_geom, all_touched=all_touched, sparse=sparse, cog=cog, compress=compress, predictor=predictor)
+
+    async def aggregate(self, area, composite, formula, grouping='continuous', zoom=None, synchronous=True):
+        return await aggregate(self.client, area, composite, formula, grouping, zoom, synchronous)
+
+    async def aggregate_many(self, areas, composite, formula, grouping='continuous', zoom=None, poll_interval=1, max_poll_interval=30, timeout=None):
+        return await aggregate_many(self.client, areas, composite, formula, grouping, zoom, poll_interval, max_poll_interval, timeout)
@@ -0,0 +1,236 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+class TileCache(object):
+    """
+    Persistent tile cache on the local file system.
+
+    Tiles are stored under the hash of their key, and files are written
+    atomically by renaming complete temporary files into place. Reading a tile
+    touches its file, so the oldest modification times mark the least recently
+    used tiles. This allows several processes to share one cache directory.
+
+    Once the cache exceeds max_size, tiles are evicted until it is below the
+    low_water fraction of max_size, so that the directory is not scanned on
+    every write.
+    """
+
+    # Temporary files older than this are leftovers from crashed writers.
+    stale_tmp_age = 3600
+
+    def __init__(self, directory, max_size=2 * 1024 ** 3, low_water=0.8):
+        self.directory = directory
+        self.max_size = max_size
+        self.low_water = low_water
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'bytes_read': 0,
+            'bytes_written': 0,
+            'evictions': 0,
+        }
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Approximate size of the cache, other processes might add files.
+        self._size = sum(size for path, mtime, size in self._entries())
+
+    @staticmethod
+    def key(*parts):
+        """
+        Compute the cache key from the parts that identify a tile.
+        """
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                self.stats[name] += value
+
+    def get(self, key):
+        """
+        Get tile data from the cache, returns None if the tile is not cached.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as fl:
+                data = fl.read()
+            # Mark the tile as recently used.
+            os.utime(path)
+        except FileNotFoundError:
+            self._count(misses=1)
+            return
+
+        self._count(hits=1, bytes_read=len(data))
+
+        return data
+
+    def set(self, key, data):
+        """
+        Store tile data in the cache.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file in the target directory and move it into
+        # place, so that readers never see partial tiles.
+        handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'wb') as fl:
+                fl.write(data)
+            os.replace(tmp_path, path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+        self._count(bytes_written=len(data))
+
+        with self._lock:
+            self._size += len(data)
+            evict = self._size > self.max_size
+
+        if evict:
+            self.evict()
+
+    def _entries(self):
+        """
+        List path, modification time and size of all cached tiles.
+        """
+        now = time.time()
+        entries = []
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.endswith('.tmp'):
+                    if now - stat.st_mtime > self.stale_tmp_age:
+                        _remove(path)
+                    continue
+                entries.append((path, stat.st_mtime, stat.st_size))
+        return entries
+
+    def evict(self):
+        """
+        Remove least recently used tiles until the cache is below the low water
+        mark of its size limit.
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        size = sum(entry[2] for entry in entries)
+        target = self.max_size * self.low_water
+        evictions = 0
+        for path, mtime, entry_size in entries:
+            if size <= target:
+                break
+            if _remove(path):
+                evictions += 1
+            size -= entry_size
+
+        logging.debug('Evicted {} tiles from cache.'.format(evictions))
+
+        with self._lock:
+            self._size = size
+            self.stats['evictions'] += evictions
+
+    def clear(self):
+        """
+        Remove all tiles from the cache.
+        """
+        for path, mtime, size in self._entries():
+            _remove(path)
+        with self._lock:
+            self._size = 0
+
+
+class ResponseCache(object):
+    """
+    In memory LRU cache for json responses of get requests.
+
+    The time to live in seconds is set per endpoint, endpoints without ttl are
+    not cached. Expired entries are kept with their ETag and Last-Modified
+    headers for conditional revalidation.
+    """
+
+    def __init__(self, ttls, default_ttl=0, max_entries=1000):
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.max_entries = max_entries
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'revalidations': 0,
+            'invalidations': 0,
+        }
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def ttl(self, endpoint):
+        return self.ttls.get(endpoint, self.default_ttl)
+
+    def get(self, url):
+        """
+        Get the cache entry for the url, fresh or expired. Returns None if the
+        url is not cached.
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry:
+                self._entries.move_to_end(url)
+            return entry
+
+    def set(self, url, endpoint, data, etag=None, last_modified=None):
+        with self._lock:
+            self._entries[url] = {
+                'endpoint': endpoint,
+                'data': data,
+                'etag': etag,
+                'last_modified': last_modified,
+                'expires': time.time() + self.ttl(endpoint),
+            }
+            self._entries.move_to_end(url)
+            # Remove least recently used entries.
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def refresh(self, url):
+        """
+        Restart the time to live of an entry after a successful revalidation.
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry:
+                entry['expires'] = time.time() + self.ttl(entry['endpoint'])
+            self.stats['revalidations'] += 1
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def invalidate(self, endpoint):
+        """
+        Remove all entries of an endpoint.
+        """
+        with self._lock:
+            urls = [url for url, entry in self._entries.items() if entry['endpoint'] == endpoint]
+            for url in urls:
+                del self._entries[url]
+            self.stats['invalidations'] += len(urls)
+
+
+def _remove(path):
+    # Other processes might have removed the file already.
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return False
+    return True
@@ -1,11 +1,69 @@
+import copy
 import logging
 import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
 from urllib.parse import urlencode
 
 import requests
+from requests.adapters import HTTPAdapter
 
+from tesselate import const
+from tesselate.cache import ResponseCache, TileCache
 from tesselate.utils import confirm
 
+# Methods that can be repeated safely after a failure.
+IDEMPOTENT_METHODS = ('get', 'patch', 'delete')
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket rate limiter.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token from the bucket, waiting until it is available. Returns
+        the time waited in seconds.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserve the token, waiting threads queue up in negative tokens.
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+        return wait
+
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    """
+    HTTP adapter with a default timeout for all requests.
+    """
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
+
 
 class Client(object):
 
@@ -13,13 +71,42 @@ class Client(object):
 
     session = None
 
+    tile_cache = None
+
+    response_cache = None
+
+    rate_limiter = None
+
+    # Retry policy, no retries by default.
+    retries = 0
+    backoff_factor = 0.5
+    max_backoff = 60
+    retry_statuses = (429, 500, 502, 503, 504)
+
     def __init__(self):
+        # Request counters.
+        self.metrics = {
+            'requests': 0,
+            'retries': 0,
+            'rate_limited': 0,
+            'throttled': 0,
+            'throttle_wait': 0.0,
+        }
+        self._metrics_lock = threading.Lock()
+
+        # Create the session with default connection pool.
+        self.set_pool_options()
+
         # Get token from env if available.
         if 'TESSELO_ACCESS_TOKEN' in os.environ:
             token = os.environ.get('TESSELO_ACCESS_TOKEN')
             self.set_token(token)
 
     def raise_for_status(self, response):
+        """
+        Raise an error for failed responses, logging the response text. Requests
+        made through the client are checked and retried automatically.
+        """
         try:
             response.raise_for_status()
         except requests.exceptions.HTTPError:
@@ -30,9 +117,13 @@ class Client(object):
         """
         Authinticate a user by getting a fresh auth token.
         """
-        response = requests.post(self.api + 'token-auth/', data={'username': username, 'password': password})
-
-        self.raise_for_status(response)
+        # Use the pooled session, but without any previous auth header.
+        response = self._request(
+            'post',
+            self.api + 'token-auth/',
+            data={'username': username, 'password': password},
+            headers={'Authorization': None},
+        )
 
         response = response.json()
 
@@ -45,15 +136,205 @@ class Client(object):
 
     def set_token(self, token):
         """
-        Initiate requests session with a standard token-based authorization header.
+        Set a standard token-based authorization header on the session. The
+        session and its pooled connections are kept.
         """
         self.token = token
 
         auth_header = {'Authorization': 'Token {}'.format(token)}
 
-        self.session = requests.Session()
         self.session.headers.update(auth_header)
 
+    def set_pool_options(self, pool_connections=10, pool_maxsize=10, pool_block=False, timeout=None, keep_alive=True):
+        """
+        Configure the connection pool of the session.
+
+        The pool_maxsize is the number of connections kept open per host, it
+        should be at least the number of threads sharing this client. With
+        pool_block, threads wait for a free connection instead of opening
+        additional ones. The timeout in seconds applies to all requests, it
+        can be a (connect, read) tuple.
+
+        Changing the options replaces the current pool and its connections.
+        """
+        if self.session is None:
+            self.session = requests.Session()
+
+        adapter = TimeoutHTTPAdapter(
+            timeout=timeout,
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+        )
+        for prefix in ('https://', 'http://'):
+            old = self.session.adapters.get(prefix)
+            self.session.mount(prefix, adapter)
+            if old:
+                old.close()
+
+        if keep_alive:
+            self.session.headers.pop('Connection', None)
+        else:
+            self.session.headers['Connection'] = 'close'
+
+    def set_tile_cache(self, directory, max_size=2 * 1024 ** 3):
+        """
+        Cache tiles in a local directory. The max_size is the size limit of the
+        cache in bytes. Set the directory to None to disable tile caching.
+
+        Cache statistics are tracked on the tile_cache.stats dictionary.
+        """
+        if directory is None:
+            self.tile_cache = None
+        else:
+            self.tile_cache = TileCache(directory, max_size=max_size)
+
+    def set_response_cache(self, ttls=const.RESPONSE_CACHE_TTLS, default_ttl=0, max_entries=1000):
+        """
+        Cache json responses of get requests in memory.
+
+        The ttls dict sets the time to live in seconds per endpoint, other
+        endpoints use the default ttl. Expired responses are revalidated with
+        conditional requests. Posts, patches and deletes on an endpoint remove
+        its responses from the cache. Set the ttls to None to disable caching.
+        """
+        if ttls is None:
+            self.response_cache = None
+        else:
+            self.response_cache = ResponseCache(ttls, default_ttl=default_ttl, max_entries=max_entries)
+
+    def _endpoint(self, url):
+        """
+        Get the endpoint name from an url.
+        """
+        if url.startswith(self.api):
+            url = url[len(self.api):]
+        return url.split('?')[0].split('/')[0]
+
+    def _invalidate(self, url):
+        if self.response_cache:
+            self.response_cache.invalidate(self._endpoint(url))
+
+    def _cached_get(self, url):
+        """
+        Get json data through the response cache.
+        """
+        cache = self.response_cache
+        endpoint = self._endpoint(url)
+        if not cache.ttl(endpoint):
+            return self._request('get', url).json()
+
+        entry = cache.get(url)
+        if entry and entry['expires'] > time.time():
+            cache.count('hits')
+            return copy.deepcopy(entry['data'])
+
+        # Revalidate expired entries with a conditional request.
+        headers = {}
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        response = self._request('get', url, headers=headers)
+
+        if response.status_code == 304 and entry:
+            cache.refresh(url)
+            return copy.deepcopy(entry['data'])
+
+        cache.count('misses')
+        data = response.json()
+        cache.set(url, endpoint, data, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+
+        # Return a copy, callers might modify the data.
+        return copy.deepcopy(data)
+
+    def set_retry_policy(self, retries=3, backoff_factor=0.5, max_backoff=60, statuses=(429, 500, 502, 503, 504)):
+        """
+        Retry failed requests with exponential backoff and jitter.
+
+        Requests failing with one of the given statuses or with a connection
+        error are repeated up to retries times. Only get, patch and delete
+        requests are repeated, post requests are only repeated if the server
+        rejected them with a 429 status. Retry-After headers are respected.
+        """
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.retry_statuses = statuses
+
+    def set_rate_limit(self, rate, burst=None):
+        """
+        Limit the number of requests per second. The limit is shared by all
+        threads using this client. Set the rate to None to disable the limit.
+        """
+        if rate is None:
+            self.rate_limiter = None
+        else:
+            self.rate_limiter = TokenBucket(rate, burst)
+
+    def _count(self, name, value=1):
+        with self._metrics_lock:
+            self.metrics[name] += value
+
+    def _retry_delay(self, attempt, response=None):
+        """
+        Compute the wait time before the next attempt.
+        """
+        # Use the server instructions if available.
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return min(self.max_backoff, max(0, float(retry_after)))
+            except ValueError:
+                pass
+            try:
+                return min(self.max_backoff, max(0, parsedate_to_datetime(retry_after).timestamp() - time.time()))
+            except (TypeError, ValueError):
+                # Ignore invalid headers.
+                pass
+        # Exponential backoff with full jitter.
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** attempt))
+
+    def _request(self, method, url, **kwargs):
+        """
+        Send a request through the session, applying the rate limit and the
+        retry policy. Raises an error for failed requests.
+        """
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                wait = self.rate_limiter.acquire()
+                if wait:
+                    self._count('throttled')
+                    self._count('throttle_wait', wait)
+            self._count('requests')
+
+            try:
+                response = getattr(self.session, method)(url, **kwargs)
+                response.raise_for_status()
+                return response
+            except requests.exceptions.HTTPError as e:
+                status = e.response.status_code
+                if status == 429:
+                    self._count('rate_limited')
+                retry = attempt < self.retries and status in self.retry_statuses and (method in IDEMPOTENT_METHODS or status == 429)
+                if not retry:
+                    logging.error(e.response.text)
+                    raise
+                delay = self._retry_delay(attempt, e.response)
+                reason = 'status {}'.format(status)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= self.retries or method not in IDEMPOTENT_METHODS:
+                    raise
+                delay = self._retry_delay(attempt)
+                reason = e.__class__.__name__
+
+            logging.warning('Request to {} failed with {}, retrying in {:.1f} seconds.'.format(url, reason, delay))
+            self._count('retries')
+            time.sleep(delay)
+            attempt += 1
+
     def get(self, url, json_response=True):
         """
         Make a get request to api. Assumes json response. The input url can be passed
@@ -63,11 +344,12 @@ class Client(object):
         if not url.startswith(self.api):
             url = self.api + url
 
-        # Get response.
-        response = self.session.get(url)
+        # Use the response cache if enabled.
+        if json_response and self.response_cache:
+            return self._cached_get(url)
 
-        # Check for errors in response.
-        self.raise_for_status(response)
+        # Get response, errors are raised after retries.
+        response = self._request('get', url)
 
         if json_response:
             return response.json()
@@ -79,11 +361,10 @@ class Client(object):
         if not url.startswith(self.api):
             url = self.api + url
 
-        # Get response.
-        response = self.session.post(url, json=data)
+        # Get response, errors are raised after retries.
+        response = self._request('post', url, json=data)
 
-        # Check for errors in response.
-        self.raise_for_status(response)
+        self._invalidate(url)
 
         return response.json()
 
@@ -92,11 +373,10 @@ class Client(object):
         if not url.startswith(self.api):
             url = self.api + url
 
-        # Get response.
-        response = self.session.patch(url, json=data)
+        # Get response, errors are raised after retries.
+        response = self._request('patch', url, json=data)
 
-        # Check for errors in response.
-        self.raise_for_status(response)
+        self._invalidate(url)
 
         return response.json()
 
@@ -109,27 +389,64 @@ class Client(object):
         if not force and not confirm('delete the object at {}'.format(url)):
             return
 
-        # Get response.
-        response = self.session.delete(url)
+        # Send request, errors are raised after retries.
+        self._request('delete', url)
+
+        self._invalidate(url)
+
+    def iterate(self, endpoint, prefetch=True, **kwargs):
+        """
+        Iterate over all records of a list endpoint, requesting the pages one by
+        one as they are consumed.
+        """
+        return self.dispatch(endpoint, all_pages=True, prefetch=prefetch, **kwargs)
 
-        # Check for errors in response.
-        self.raise_for_status(response)
+    def _iterate_pages(self, url, prefetch=True):
+        """
+        Yield the records of a paginated list response, following the next page
+        links. With prefetch, the next page is requested in the background while
+        the records of the current page are consumed.
+        """
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        try:
+            response = self.get(url)
+            while True:
+                # Non paginated responses are simple lists.
+                if not isinstance(response, dict):
+                    yield from response
+                    return
+                next_url = response.get('next', None)
+                if next_url and executor:
+                    next_response = executor.submit(self.get, next_url)
+                yield from response['results']
+                if not next_url:
+                    return
+                response = next_response.result() if executor else self.get(next_url)
+        finally:
+            if executor:
+                executor.shutdown()
 
     def dispatch(self, endpoint, **kwargs):
         """
         Dispatch REST requests.
+
+        For list requests, pass all_pages=True to get a generator over the
+        records of all pages instead of the first page only.
         """
         # Get json response keyword.
         json_response = kwargs.pop('json_response', True)
 
+        # Get pagination keywords.
+        all_pages = kwargs.pop('all_pages', False)
+        prefetch = kwargs.pop('prefetch', True)
+
         # Get data arg if available.
         data = kwargs.pop('data', {})
 
         # Get id using either id or id keyword.
+        id = kwargs.pop('id', None)
         if 'id' in data:
             id = data.get('id', None)
-        else:
-            id = kwargs.pop('id', None)
 
         # Add id to endpoint if provided.
         if id:
@@ -189,6 +506,12 @@ class Client(object):
             params = urlencode(kwargs, safe='[]{}()=/')
             endpoint += '?{}'.format(params)
 
+        # Iterate over all pages of list requests.
+        if all_pages:
+            if id or data or permission:
+                raise ValueError('All pages can only be requested for list queries.')
+            return self._iterate_pages(endpoint, prefetch=prefetch)
+
         # For requests with data, dispatch post or patch.
         if data:
             if id:
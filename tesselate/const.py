@@ -16,3 +16,13 @@ LOOKUP = {
     'B12': 'B12.jp2',
 }
 NODATA_VALUE = 0
+# Status of asynchronous value count results.
+VALUECOUNT_FINISHED = 'Finished'
+VALUECOUNT_FAILED = 'Failed'
+# Default time to live in seconds for cached api responses.
+RESPONSE_CACHE_TTLS = {
+    'aggregationarea': 3600,
+    'aggregationlayer': 3600,
+    'composite': 3600,
+    'formula': 3600,
+}
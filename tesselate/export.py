@@ -1,21 +1,321 @@
+import functools
+import itertools
+import json
 import logging
-import tempfile
+import os
 import uuid
+from ctypes import POINTER, byref, c_buffer, c_char_p, c_int, c_void_p
+from xml.etree import ElementTree
 
 import numpy
+import requests
 from django.contrib.gis.gdal import GDALException, GDALRaster, OGRGeometry
+from django.contrib.gis.gdal.driver import Driver
+from django.contrib.gis.gdal.libgdal import std_call
+from django.contrib.gis.gdal.prototypes.generation import void_output
+from django.contrib.gis.gdal.prototypes.raster import (
+    close_ds, copy_ds, create_vsi_file_from_mem_buffer, flush_ds, unlink_vsi_file
+)
+from django.contrib.gis.geos import GeometryCollection, GEOSGeometry
 from raster.rasterize import rasterize
 from raster.tiles.const import WEB_MERCATOR_SRID, WEB_MERCATOR_TILESIZE
 from raster.tiles.utils import tile_bounds, tile_index_range, tile_scale
 
 from tesselate import const, tiles
-from tesselate.utils import populate_aggregation_areas
+from tesselate.utils import concurrent_map, populate_aggregation_areas
 
+# GDAL function to compute overviews, not exposed by django.
+build_overviews = void_output(
+    std_call('GDALBuildOverviews'),
+    [c_void_p, c_char_p, c_int, POINTER(c_int), c_int, POINTER(c_int), c_void_p, c_void_p],
+    cpl=True,
+)
+
+# GDAL function to read or write several bands in one call.
+dataset_raster_io = void_output(
+    std_call('GDALDatasetRasterIO'),
+    [c_void_p, c_int, c_int, c_int, c_int, c_int, c_void_p, c_int, c_int, c_int, c_int, POINTER(c_int), c_int, c_int, c_int],
+    cpl=True,
+)
+
+# GDAL data types of the decoded tile arrays.
+GDAL_BUFFER_TYPES = {
+    'uint8': 1,
+    const.RASTER_DATATYPE: const.RASTER_DATATYPE_GDAL,
+}
+
+
+def export(client, region, composite, formula, file_path=None, zoom=14, clip_to_geom=False, all_touched=False, workers=None, pipeline=None, sparse=False, cog=False, compress='deflate', predictor=None, chunk_size=None, resume=False, out=None):
+    """
+    Export the formula evaluated on the composite over the region.
+
+    The formula can also be a list of formulas, in which case the target
+    raster has one band per formula in the same order. The requests for all
+    formulas of a tile are scheduled together, and each tile is written once
+    all its bands are available.
+
+    If workers is larger than one, tiles are fetched concurrently through the
+    client session. The tiles are written to the target raster in the same
+    order as in the serial case, so the output is identical.
+
+    Alternatively, a tesselate.pipeline.Pipeline instance can be passed to run
+    fetching, decoding and writing as separate stages. The per-stage counters
+    are available on the pipeline object.
+
+    With sparse, only tiles that intersect with the region geometry are
+    fetched. The other tiles are left empty and take no space on disk.
+
+    The target raster is tiled with the web mercator tile size, the compression
+    and predictor can be set through the compress and predictor arguments. With
+    cog, the file is written as a Cloud Optimized GeoTIFF with overviews.
+
+    With chunk_size, the region is exported in blocks of chunk_size by
+    chunk_size tiles into separate files, and the file path is written as a
+    VRT mosaic of the blocks. Interrupted chunked exports can be restarted and
+    only export the missing blocks.
+
+    With resume, completed and failed tiles are recorded in a manifest file
+    next to the file path. Tiles that can not be fetched or decoded are
+    recorded as failed instead of aborting the export, and the sorted list of
+    failed tiles is returned. Running the export again with the same arguments
+    continues writing into the existing raster and only fetches the missing
+    tiles. The manifest is removed once all tiles are exported.
+
+    With out, the tiles are written directly into a numpy array instead of a
+    raster, and the array is returned together with its geotransform. The out
+    argument is either a path for a new numpy memmap, or an array of the export
+    shape that is filled in place.
+    """
+    if resume and (not file_path or chunk_size):
+        raise ValueError('Resume requires a file path and is not available for chunked exports.')
+
+    if out is not None:
+        if file_path or chunk_size or resume or cog:
+            raise ValueError('Array output can not be combined with file output.')
+        return _export_array(client, region, composite, formula, out, zoom, clip_to_geom, all_touched, workers, pipeline, sparse)
+
+    if cog and not file_path:
+        raise ValueError('Cloud optimized exports require a file path.')
+
+    if chunk_size:
+        return _export_chunks(client, region, composite, formula, file_path, zoom, chunk_size, clip_to_geom, all_touched, workers, pipeline, sparse, cog, compress, predictor)
+
+    manifest = None
+    if resume:
+        manifest = file_path + '.manifest'
+        target, index_range, tile_indices, rgb, clip = _resume_export(client, region, composite, formula, file_path, manifest, zoom, sparse, workers, cog, compress, predictor, clip_to_geom, all_touched)
+    else:
+        target, index_range, tile_indices, rgb, clip = _setup_export(client, region, composite, formula, _work_path(file_path, cog), zoom, sparse, workers, compress, predictor, clip_to_geom, all_touched)
+
+    failed = _process_tiles(client, target, index_range, tile_indices, composite, formula, zoom, rgb, workers, pipeline, manifest, clip)
+
+    # Keep the raster and manifest for the next run if tiles are missing.
+    if failed:
+        logging.warning('Failed to export {} tiles, run export again with resume to retry.'.format(len(failed)))
+        return failed
+
+    result = _finish_export(target, file_path if cog else None, compress, predictor)
+
+    if manifest:
+        os.remove(manifest)
+
+    return result
+
+
+def iter_tiles(client, region, composite, formula, zoom=14, workers=None, ordered=True, sparse=False):
+    """
+    Iterate over the tiles of the formula evaluated on the composite over the
+    region, without creating a target raster.
+
+    Yields tuples of tile x and y index, tile bounds in web mercator and the
+    decoded tile data as array with one band per formula and three bands for
+    rgb. Tiles that can not be decoded are skipped.
+
+    If workers is larger than one, tiles are fetched and decoded concurrently.
+    The number of tiles held in memory is bounded by the number of workers. If
+    ordered is False, tiles are yielded as soon as they arrive.
+    """
+    index_range, tile_indices, rgb, clip = _plan_export(client, region, composite, formula, zoom, sparse, workers)
+
+    decode = _decoder(formula, rgb)
+
+    def process(tile):
+        return tile, decode(_fetch_tile(client, zoom, tile[0], tile[1], composite, formula, rgb))
+
+    for tile, data in concurrent_map(process, tile_indices, workers=workers, ordered=ordered):
+        if data is None:
+            continue
+        yield tile[0], tile[1], tile_bounds(tile[0], tile[1], zoom), data
+
+
+def _process_tiles(client, target, index_range, tile_indices, composite, formula, zoom, rgb=False, workers=None, pipeline=None, manifest=None, clip=None):
+    """
+    Fetch, decode and write the tiles into the target raster. If a clip
+    function is given, it is applied to every tile before writing.
+
+    If a manifest path is given, tiles that can not be fetched or decoded are
+    skipped, and the written tiles are appended to the manifest in batches
+    after flushing the raster. Returns the list of failed tiles.
+    """
+    failed = set()
+    formulas = formula if isinstance(formula, list) else [formula]
+
+    def fetch_formula(tile, item):
+        try:
+            return _fetch_tile(client, zoom, tile[0], tile[1], composite, item, rgb)
+        except requests.exceptions.RequestException as e:
+            # Without manifest, failed tiles abort the export.
+            if not manifest:
+                raise
+            logging.error('Failed to fetch tile {} {}: {}'.format(tile[0], tile[1], e))
+            failed.add(tile)
+
+    def fetch(tile):
+        if isinstance(formula, list):
+            return [fetch_formula(tile, item) for item in formulas]
+        return fetch_formula(tile, formula)
+
+    decode = _decoder(formula, rgb)
+    # Without manifest, tiles that can not be decoded abort the export.
+    if manifest:
+        decode = functools.partial(_decode_or_error, decode)
+
+    counter = itertools.count()
+    entries = []
+
+    def commit():
+        # Flush the raster before recording the tiles as completed.
+        flush_ds(target._ptr)
+        _write_manifest(manifest, entries)
+        del entries[:]
+
+    def write(tile, data):
+        # Log progress.
+        index = next(counter)
+        if index % 100 == 0:
+            logging.info('Processed {}/{} tiles.'.format(index, len(tile_indices)))
+        if isinstance(data, GDALException):
+            logging.error('Failed to decode tile {} {}: {}'.format(tile[0], tile[1], data))
+            failed.add(tile)
+            data = None
+        if clip:
+            data = clip(tile, data)
+        _write_tile(data, tile[0], tile[1], index_range, target)
+        if manifest:
+            entries.append([tile[0], tile[1], 'failed' if tile in failed else 'done'])
+            if len(entries) >= 100:
+                commit()
+
+    try:
+        if pipeline:
+            # Run fetch, decode and write as separate stages.
+            pipeline.run(tile_indices, fetch, decode, write)
+            logging.debug('Export pipeline stats {}.'.format(pipeline.stats()))
+        else:
+            # Fetch tiles, concurrently if requested. The requests for all
+            # formulas of a tile are scheduled together.
+            pairs = ((tile, item) for tile in tile_indices for item in formulas)
+            results = concurrent_map(lambda pair: fetch_formula(*pair), pairs, workers=workers)
+            # Write tiles from this thread only, GDAL datasets are not thread safe.
+            for tile in tile_indices:
+                data = [next(results) for item in formulas]
+                write(tile, decode(data if isinstance(formula, list) else data[0]))
+    finally:
+        # Record the tiles written before an interruption.
+        if entries:
+            commit()
+
+    return sorted(failed)
+
+
+def _export_chunks(client, region, composite, formula, file_path, zoom, chunk_size, clip_to_geom=False, all_touched=False, workers=None, pipeline=None, sparse=False, cog=False, compress='deflate', predictor=None):
+    """
+    Export the region in square blocks of chunk_size by chunk_size tiles.
+
+    Every block is written into its own file next to the file path, and a VRT
+    mosaic of all blocks is written to the file path. Blocks that exist from a
+    previous run are not exported again.
+    """
+    if not file_path:
+        raise ValueError('Chunked exports require a file path for the VRT mosaic.')
+
+    index_range, tile_indices, rgb, clip = _plan_export(client, region, composite, formula, zoom, sparse, workers, clip_to_geom, all_touched)
+    tile_indices = set(tile_indices)
+
+    base = os.path.splitext(file_path)[0]
+    blocks = []
+    for xmin in range(index_range[0], index_range[2] + 1, chunk_size):
+        for ymin in range(index_range[1], index_range[3] + 1, chunk_size):
+            block_range = (
+                xmin,
+                ymin,
+                min(xmin + chunk_size - 1, index_range[2]),
+                min(ymin + chunk_size - 1, index_range[3]),
+            )
+            block_tiles = [tile for tile in _tile_indices(block_range) if tile in tile_indices]
+            # Sparse and clipped exports skip blocks without intersecting tiles.
+            if not block_tiles:
+                continue
+            block_path = '{}_{}_{}.tif'.format(base, xmin, ymin)
+            blocks.append((block_range, block_path))
+
+            # Skip blocks that were completed in a previous run.
+            if os.path.exists(block_path):
+                logging.info('Found block {}, skipping.'.format(block_path))
+                continue
+
+            # Write into a temporary file, so that only complete blocks exist
+            # under the block path.
+            logging.info('Exporting block {}.'.format(block_path))
+            target = _create_target_raster(block_range, block_path + '.tmp', zoom, rgb, sparse, compress, predictor, _band_count(formula, rgb))
+            _process_tiles(client, target, block_range, block_tiles, composite, formula, zoom, rgb, workers, pipeline, clip=clip)
+            if cog:
+                _write_cog(target, block_path + '.cog.tmp', compress, predictor)
+                os.replace(block_path + '.cog.tmp', block_path)
+            else:
+                # Close the file before moving it into place.
+                del target
+                os.replace(block_path + '.tmp', block_path)
+
+    _write_vrt(file_path, index_range, zoom, blocks, rgb, _band_count(formula, rgb))
+
+
+def _export_array(client, region, composite, formula, out, zoom, clip_to_geom=False, all_touched=False, workers=None, pipeline=None, sparse=False):
+    """
+    Export the region into a numpy array or memmap, returns the array and its
+    geotransform.
+    """
+    index_range, tile_indices, rgb, clip = _plan_export(client, region, composite, formula, zoom, sparse, workers, clip_to_geom, all_touched)
+
+    # Create memmap or check the shape of the output array.
+    origin, width, height, scale = _get_geotransform(index_range, zoom)
+    shape = (_band_count(formula, rgb), height, width)
+    if isinstance(out, str):
+        out = numpy.memmap(out, dtype='uint8' if rgb else const.RASTER_DATATYPE, mode='w+', shape=shape)
+    elif out.shape != shape:
+        raise ValueError('Output array shape {} does not match export shape {}.'.format(out.shape, shape))
+
+    _process_tiles(client, out, index_range, tile_indices, composite, formula, zoom, rgb, workers, pipeline, clip=clip)
+
+    if isinstance(out, numpy.memmap):
+        out.flush()
+
+    return out, [origin[0], scale, 0, origin[1], 0, -scale]
+
+
+def _plan_export(client, region, composite, formula, zoom, sparse=False, workers=None, clip_to_geom=False, all_touched=False):
+    """
+    Compute the tile index range and list the tiles to process for an export.
+
+    In sparse mode, only the tiles that intersect with the region geometry
+    are processed. This also applies when clipping to the geometry, in which
+    case a function to clip the tiles is returned as well.
+    """
+    formulas = formula if isinstance(formula, list) else [formula]
 
-def export(client, region, composite, formula, file_path=None, zoom=14, clip_to_geom=False, all_touched=False):
     logging.info('Processing aggregation{} "{}" over "{}" for "{}" at zoom "{}"'.format(
         'layer' if 'aggregationareas' in region else 'area',
-        formula['name'],
+        ', '.join(item['name'] for item in formulas),
         region['name'],
         composite['name'],
         zoom,
@@ -25,91 +325,327 @@ def export(client, region, composite, formula, file_path=None, zoom=14, clip_to_
     geom = OGRGeometry.from_bbox(region['extent'])
     geom.srid = 4326
     geom.transform(WEB_MERCATOR_SRID)
-    extent = geom.extent
 
     # Compute target index range.
-    index_range = tile_index_range(extent, zoom)
+    index_range = tile_index_range(geom.extent, zoom)
 
     # Check if this is an rgb raster.
-    rgb = formula['acronym'].lower() == 'rgb'
+    rgb = any(item['acronym'].lower() == 'rgb' for item in formulas)
+    if rgb and len(formulas) > 1:
+        raise ValueError('The rgb formula can not be combined with other formulas.')
+
+    # List tiles to process.
+    clip = None
+    if sparse or clip_to_geom:
+        geom = _region_geometry(client, region, workers=workers)
+        inside = set()
+        tile_indices = _intersecting_tiles(geom, index_range, zoom, inside)
+        if clip_to_geom:
+            clip = _tile_clipper(geom, inside, zoom, all_touched)
+    else:
+        tile_indices = list(_tile_indices(index_range))
+    logging.info('Found {} tiles to process for export.'.format(len(tile_indices)))
+
+    return index_range, tile_indices, rgb, clip
+
+
+def _setup_export(client, region, composite, formula, file_path, zoom, sparse=False, workers=None, compress='deflate', predictor=None, clip_to_geom=False, all_touched=False):
+    """
+    Create the target raster and list the tiles to process for an export.
+    """
+    index_range, tile_indices, rgb, clip = _plan_export(client, region, composite, formula, zoom, sparse, workers, clip_to_geom, all_touched)
 
     # Create target raster.
-    target = _create_target_raster(extent, file_path, zoom, rgb)
+    target = _create_target_raster(index_range, file_path, zoom, rgb, sparse, compress, predictor, _band_count(formula, rgb))
 
-    # Compute nr of tiles to process.
-    tile_count = (index_range[2] - index_range[0] + 1) * (index_range[3] - index_range[1] + 1)
-    counter = 0
-    logging.info('Found {} tiles to process for export.'.format(tile_count))
+    return target, index_range, tile_indices, rgb, clip
+
+
+def _resume_export(client, region, composite, formula, file_path, manifest, zoom, sparse=False, workers=None, cog=False, compress='deflate', predictor=None, clip_to_geom=False, all_touched=False):
+    """
+    Open the target raster of a previous run and list the tiles that are not
+    completed yet. If there is no previous run, a new target raster and
+    manifest are created.
+    """
+    header = {
+        'region': region['id'],
+        'composite': composite['id'],
+        'formula': [item['id'] for item in formula] if isinstance(formula, list) else formula['id'],
+        'zoom': zoom,
+    }
+    work_path = _work_path(file_path, cog)
+
+    index_range, tile_indices, rgb, clip = _plan_export(client, region, composite, formula, zoom, sparse, workers, clip_to_geom, all_touched)
+
+    if os.path.exists(manifest) and os.path.exists(work_path):
+        completed, failed = read_manifest(manifest, header)
+        # Continue writing into the raster of the previous run.
+        target = GDALRaster(work_path, write=True)
+        tile_indices = [tile for tile in tile_indices if tile not in completed]
+        logging.info('Resuming export with {} remaining tiles.'.format(len(tile_indices)))
+    else:
+        target = _create_target_raster(index_range, work_path, zoom, rgb, sparse, compress, predictor, _band_count(formula, rgb))
+        with open(manifest, 'w') as fl:
+            fl.write(json.dumps(header) + '\n')
+
+    return target, index_range, tile_indices, rgb, clip
 
-    # Get and write tiles.
-    for tilex in range(index_range[0], index_range[2] + 1):
-        for tiley in range(index_range[1], index_range[3] + 1):
-            # Log progress.
-            if counter % 100 == 0:
-                logging.info('Processed {}/{} tiles.'.format(counter, tile_count))
-            counter += 1
 
-            if formula['acronym'] == 'RGB':
-                _process_rgb(client, zoom, tilex, tiley, index_range, formula, composite, target)
+def read_manifest(manifest, header=None):
+    """
+    Read the sets of completed and failed tiles from an export manifest. If a
+    header is given, it has to match the header of the manifest.
+    """
+    completed = set()
+    failed = set()
+    if not os.path.exists(manifest):
+        return completed, failed
+
+    with open(manifest, 'r') as fl:
+        manifest_header = json.loads(fl.readline())
+        if header and manifest_header != header:
+            raise ValueError('Manifest {} belongs to a different export {}.'.format(manifest, manifest_header))
+        for line in fl:
+            # Ignore incomplete lines from interrupted writes.
+            try:
+                tilex, tiley, status = json.loads(line)
+            except ValueError:
+                continue
+            # Later entries replace earlier ones for retried tiles.
+            if status == 'done':
+                completed.add((tilex, tiley))
+                failed.discard((tilex, tiley))
             else:
-                _process_algebra(client, zoom, tilex, tiley, index_range, formula, composite, target)
+                failed.add((tilex, tiley))
+
+    logging.info('Found {} completed and {} failed tiles in manifest.'.format(len(completed), len(failed)))
+
+    return completed, failed
+
 
-    # Clip to geometry.
-    if clip_to_geom:
-        _clip_to_geom(client, target, region, all_touched=all_touched)
+def _write_manifest(manifest, entries):
+    """
+    Append tile entries to the manifest file.
+    """
+    with open(manifest, 'a') as fl:
+        for entry in entries:
+            fl.write(json.dumps(entry) + '\n')
+        fl.flush()
+        os.fsync(fl.fileno())
+
+
+def _finish_export(target, cog_path=None, compress='deflate', predictor=None):
+    """
+    Return the target raster as numpy array if no target file path has been
+    specified. If a cog path is given, the target is converted into a Cloud
+    Optimized GeoTIFF at that path.
+    """
+    # Convert to cloud optimized geotiff.
+    if cog_path:
+        _write_cog(target, cog_path, compress, predictor)
+        return
 
     # Return numpy array if no target file path has been specified.
     if target.name.startswith('/vsimem'):
         return numpy.array([band.data() for band in target.bands])
 
 
-def _process_rgb(client, zoom, tilex, tiley, index_range, formula, composite, target):
-    if not target:
-        raise ValueError('Target raster path must be specified for RGB exports.')
-    # Compute pixel offxet for this tile.
-    xoffset = (tilex - index_range[0]) * WEB_MERCATOR_TILESIZE
-    yoffset = (tiley - index_range[1]) * WEB_MERCATOR_TILESIZE
-    # Get tile.
-    data = tiles.rgb(client, zoom, tilex, tiley, composite)
-    # Open response as GDALRaster. The tempfile workaround is because the png
-    # buffer itself is not readable by GDALRaster.
-    with tempfile.NamedTemporaryFile() as tmp:
-        tmp.write(data)
-        try:
-            rst = GDALRaster(tmp.name)
-        except GDALException:
+def _tile_indices(index_range):
+    """
+    Iterate over all tile indices in the index range, column by column.
+    """
+    for tilex in range(index_range[0], index_range[2] + 1):
+        for tiley in range(index_range[1], index_range[3] + 1):
+            yield tilex, tiley
+
+
+def _intersecting_tiles(geom, index_range, zoom, inside=None):
+    """
+    List the tiles in the index range that intersect with the geometry. The
+    range is split into quadrants recursively, so that large blocks inside or
+    outside of the geometry are resolved in one step. If an inside set is
+    given, the tiles that are fully within the geometry are added to it.
+
+    Tiles that only share an edge or a corner with the geometry are skipped.
+    """
+    result = []
+
+    def split(xmin, ymin, xmax, ymax):
+        # Get the bbox of the tile block, tile y indices increase southwards.
+        bounds = tile_bounds(xmin, ymax, zoom)[:2] + tile_bounds(xmax, ymin, zoom)[2:]
+        block = OGRGeometry.from_bbox(bounds)
+        block.srid = WEB_MERCATOR_SRID
+        if not geom.intersects(block) or geom.touches(block):
             return
-        # Write data to target.
-        for band_idx in range(3):
-            target.bands[band_idx].data(
-                rst.bands[band_idx].data().astype('uint8'),  # TODO: Maybe use const.RASTER_DATATYPE
-                size=(WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE),
-                offset=(xoffset, yoffset),
-            )
+        contained = geom.contains(block)
+        if contained or (xmin == xmax and ymin == ymax):
+            block_tiles = list(_tile_indices((xmin, ymin, xmax, ymax)))
+            result.extend(block_tiles)
+            if contained and inside is not None:
+                inside.update(block_tiles)
+            return
+        # Split the block into quadrants.
+        xmid = (xmin + xmax) // 2
+        ymid = (ymin + ymax) // 2
+        for qxmin, qxmax in ((xmin, xmid), (xmid + 1, xmax)):
+            for qymin, qymax in ((ymin, ymid), (ymid + 1, ymax)):
+                if qxmin <= qxmax and qymin <= qymax:
+                    split(qxmin, qymin, qxmax, qymax)
+
+    split(*index_range)
+
+    # Use the same order as the full range.
+    return sorted(result)
 
 
-def _process_algebra(client, zoom, tilex, tiley, index_range, formula, composite, target):
-    # Fetch tile.
-    data = tiles.algebra(client, zoom, tilex, tiley, composite, formula)
+def _band_count(formula, rgb=False):
+    """
+    Get the number of bands of the export target.
+    """
+    if rgb:
+        return 3
+    if isinstance(formula, list):
+        return len(formula)
+    return 1
+
+
+def _decoder(formula, rgb=False):
+    """
+    Get the decode function for the tile data of the formula.
+    """
+    if rgb:
+        return _decode_rgb
+    if isinstance(formula, list):
+        return _decode_stack
+    return _decode_algebra
+
+
+def _fetch_tile(client, zoom, tilex, tiley, composite, formula, rgb=False):
+    """
+    Fetch the raw tile data for the formula or the rgb rendering. For a list of
+    formulas, a list with the data of each formula is returned.
+    """
+    if isinstance(formula, list):
+        return [_fetch_tile(client, zoom, tilex, tiley, composite, item, rgb) for item in formula]
+    if rgb:
+        return tiles.rgb(client, zoom, tilex, tiley, composite)
+    else:
+        return tiles.algebra(client, zoom, tilex, tiley, composite, formula)
+
+
+def _decode_rgb(data):
+    """
+    Decode a png tile into an array of the three rgb bands. Returns None if the
+    tile can not be read.
+    """
+    # Skip tiles that could not be fetched.
+    if data is None:
+        return
+    # Open response from an in-memory file. Bytes input for GDALRaster is
+    # opened in update mode, which the png driver does not support.
+    buffer = c_buffer(data, len(data))
+    path = '/vsimem/{}.png'.format(uuid.uuid4()).encode()
+    create_vsi_file_from_mem_buffer(path, byref(buffer), len(data), 0)
+    try:
+        rst = GDALRaster(path.decode())
+        # Read all three bands in one call.
+        result = numpy.empty((3, WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE), dtype='uint8')
+        _raster_io(rst, result)
+        return result
+    except GDALException:
+        return
+    finally:
+        unlink_vsi_file(path)
+
+
+def _decode_algebra(data):
+    """
+    Decode an algebra tile into a single band array.
+    """
+    # Skip tiles that could not be fetched.
+    if data is None:
+        return
     # Open response as GDALRaster.
     rst = GDALRaster(data)
+    return numpy.array([rst.bands[0].data().astype(const.RASTER_DATATYPE)])
+
+
+def _decode_or_error(decode, data):
+    """
+    Decode the tile data, returns the error instead of raising it if the data
+    can not be decoded.
+    """
+    try:
+        return decode(data)
+    except GDALException as e:
+        return e
+
+
+def _decode_stack(data):
+    """
+    Decode the algebra tiles of several formulas into one array with a band
+    per formula.
+    """
+    # Skip tiles where any formula could not be fetched.
+    if data is None or any(item is None for item in data):
+        return
+    return numpy.concatenate([_decode_algebra(item) for item in data])
+
+
+def _write_tile(data, tilex, tiley, index_range, target):
+    """
+    Write the decoded tile bands into the target raster.
+    """
+    # Skip tiles that could not be decoded.
+    if data is None:
+        return
     # Compute offset for this tile within parent raster.
     xoffset = (tilex - index_range[0]) * WEB_MERCATOR_TILESIZE
     yoffset = (tiley - index_range[1]) * WEB_MERCATOR_TILESIZE
-    # Write data into raster.
-    target.bands[0].data(
-        rst.bands[0].data().astype(const.RASTER_DATATYPE),
-        size=(WEB_MERCATOR_TILESIZE, WEB_MERCATOR_TILESIZE),
-        offset=(xoffset, yoffset),
+    # Write data into array targets directly.
+    if isinstance(target, numpy.ndarray):
+        target[:, yoffset:yoffset + WEB_MERCATOR_TILESIZE, xoffset:xoffset + WEB_MERCATOR_TILESIZE] = data
+        return
+    # Write all bands into raster in one call.
+    _raster_io(target, data, xoffset, yoffset, write=True)
+
+
+def _raster_io(rst, data, xoffset=0, yoffset=0, write=False):
+    """
+    Read or write the bands of the raster from or into a band sequential
+    array, for a window of the array size at the given offset.
+    """
+    data = numpy.ascontiguousarray(data)
+    bands, height, width = data.shape
+    dataset_raster_io(
+        rst._ptr,
+        1 if write else 0,
+        xoffset,
+        yoffset,
+        width,
+        height,
+        data.ctypes.data_as(c_void_p),
+        width,
+        height,
+        GDAL_BUFFER_TYPES[data.dtype.name],
+        bands,
+        (c_int * bands)(*range(1, bands + 1)),
+        0,
+        0,
+        0,
     )
 
 
-def _create_target_raster(bbox, file_path, zoom, rgb=False):
+def _create_target_raster(index_range, file_path, zoom, rgb=False, sparse=False, compress='deflate', predictor=None, band_count=1):
     """
     Create empty target rasters on disk for all bands. The empty rasters
     will be populated with tile data in a second step.
+
+    The rasters are tiled with the web mercator tile size, so that every tile
+    is written into exactly one block. Sparse rasters only allocate space for
+    blocks that are written.
     """
-    origin, width, height, scale = _get_geotransform(bbox, zoom)
+    origin, width, height, scale = _get_geotransform(index_range, zoom)
     logging.debug('Target geotransform {} {} {} {}.'.format(origin, width, height, scale))
 
     # Construct bands.
@@ -120,17 +656,21 @@ def _create_target_raster(bbox, file_path, zoom, rgb=False):
             {'data': [0], 'size': (1, 1), 'nodata_value': None},
         ]
         dtype = 1
-        papsz_options = {
-            'compress': 'deflate',
-            'bigtiff': 'yes',
-        }
     else:
-        bands = [{'data': [0], 'size': (1, 1), 'nodata_value': 0}]
+        bands = [{'data': [0], 'size': (1, 1), 'nodata_value': 0} for index in range(band_count)]
         dtype = const.RASTER_DATATYPE_GDAL
-        papsz_options = {
-            'compress': 'deflate',
-            'bigtiff': 'yes',
-        }
+
+    papsz_options = {
+        'compress': compress,
+        'bigtiff': 'yes',
+        'tiled': 'yes',
+        'blockxsize': WEB_MERCATOR_TILESIZE,
+        'blockysize': WEB_MERCATOR_TILESIZE,
+    }
+    if predictor:
+        papsz_options['predictor'] = predictor
+    if sparse:
+        papsz_options['sparse_ok'] = 'true'
 
     # Use vsi memory filesystem if no file path was provided.
     if not file_path:
@@ -150,40 +690,187 @@ def _create_target_raster(bbox, file_path, zoom, rgb=False):
     })
 
 
-def _get_geotransform(bbox, zoom):
+def _work_path(file_path, cog=False):
+    """
+    Get the path of the raster to write tiles into. Cloud optimized geotiffs
+    are written into a temporary file first and converted at the end.
     """
-    Compute geotransform parameters for target rasters based on bbox and zoom.
+    if cog and file_path:
+        return file_path + '.tmp'
+    return file_path
+
+
+def _overview_factors(width, height):
+    """
+    Compute the overview decimation factors, until the overview fits into one
+    tile.
+    """
+    factors = []
+    factor = 2
+    while max(width, height) / (factor // 2) > WEB_MERCATOR_TILESIZE:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def _write_cog(target, file_path, compress='deflate', predictor=None, resampling='average'):
+    """
+    Build overviews on the target raster and copy it into a Cloud Optimized
+    GeoTIFF. The temporary target file is closed and removed afterwards, the
+    target raster can not be used anymore.
+    """
+    # Build internal overviews. GDAL derives the coarser levels from the finer
+    # ones, so the full resolution data is not read again for every level.
+    factors = _overview_factors(target.width, target.height)
+    if factors:
+        logging.info('Building {} overview levels.'.format(len(factors)))
+        build_overviews(
+            target._ptr,
+            resampling.upper().encode(),
+            len(factors),
+            (c_int * len(factors))(*factors),
+            0,
+            None,
+            None,
+            None,
+        )
+
+    # Copy into cloud optimized layout, reusing the overviews.
+    options = [
+        'BLOCKSIZE={}'.format(WEB_MERCATOR_TILESIZE),
+        'OVERVIEWS=FORCE_USE_EXISTING',
+        'BIGTIFF=YES',
+        'COMPRESS={}'.format(compress),
+    ]
+    if predictor:
+        options.append('PREDICTOR={}'.format(predictor))
+    options = [option.upper().encode() for option in options] + [None]
+    cog = copy_ds(
+        Driver('COG')._ptr,
+        file_path.encode(),
+        target._ptr,
+        c_int(),
+        (c_char_p * len(options))(*options),
+        c_void_p(),
+        c_void_p(),
+    )
+    # Close the new file, and close the temporary one before removing it.
+    close_ds(cog)
+    path = target.name
+    close_ds(target._ptr)
+    target._ptr = None
+    os.remove(path)
+
+
+def _get_geotransform(index_range, zoom):
+    """
+    Compute geotransform parameters for target rasters based on the tile index
+    range and zoom.
     """
-    if not isinstance(bbox, (tuple, list)):
-        bbox = bbox.extent
-    tile_range = tile_index_range(bbox, zoom)
     scale = tile_scale(zoom)
-    bnds = tile_bounds(tile_range[0], tile_range[1], zoom)
+    bnds = tile_bounds(index_range[0], index_range[1], zoom)
     origin = (bnds[0], bnds[3])
-    xlen = tile_range[2] - tile_range[0] + 1
-    ylen = tile_range[3] - tile_range[1] + 1
+    xlen = index_range[2] - index_range[0] + 1
+    ylen = index_range[3] - index_range[1] + 1
     width = xlen * WEB_MERCATOR_TILESIZE
     height = ylen * WEB_MERCATOR_TILESIZE
     return origin, width, height, scale
 
 
-def _clip_to_geom(client, result, region, all_touched=False):
+def _write_vrt(file_path, index_range, zoom, blocks, rgb=False, band_count=1):
+    """
+    Write a VRT file that mosaics the block files of a chunked export.
+    """
+    origin, width, height, scale = _get_geotransform(index_range, zoom)
+
+    vrt = ElementTree.Element('VRTDataset', rasterXSize=str(width), rasterYSize=str(height))
+    ElementTree.SubElement(vrt, 'SRS').text = 'EPSG:{}'.format(WEB_MERCATOR_SRID)
+    ElementTree.SubElement(vrt, 'GeoTransform').text = ', '.join(
+        repr(val) for val in (origin[0], scale, 0.0, origin[1], 0.0, -scale)
+    )
+    for band_index in range(1, band_count + 1):
+        band = ElementTree.SubElement(vrt, 'VRTRasterBand', dataType='Byte' if rgb else 'Float32', band=str(band_index))
+        if not rgb:
+            ElementTree.SubElement(band, 'NoDataValue').text = '0'
+        for block_range, block_path in blocks:
+            source = ElementTree.SubElement(band, 'SimpleSource')
+            ElementTree.SubElement(source, 'SourceFilename', relativeToVRT='1').text = os.path.relpath(
+                block_path, os.path.dirname(os.path.abspath(file_path)),
+            )
+            ElementTree.SubElement(source, 'SourceBand').text = str(band_index)
+            size = {
+                'xSize': str((block_range[2] - block_range[0] + 1) * WEB_MERCATOR_TILESIZE),
+                'ySize': str((block_range[3] - block_range[1] + 1) * WEB_MERCATOR_TILESIZE),
+            }
+            ElementTree.SubElement(source, 'SrcRect', xOff='0', yOff='0', **size)
+            ElementTree.SubElement(
+                source,
+                'DstRect',
+                xOff=str((block_range[0] - index_range[0]) * WEB_MERCATOR_TILESIZE),
+                yOff=str((block_range[1] - index_range[1]) * WEB_MERCATOR_TILESIZE),
+                **size
+            )
+
+    ElementTree.ElementTree(vrt).write(file_path)
+
+
+def _region_geometry(client, region, workers=None):
+    """
+    Get the geometry of the region in web mercator. For aggregationlayers, this
+    is the union of all its areas.
+    """
     if 'aggregationareas' in region:
         # Collect geometries if this is an aggregationlayer.
-        populate_aggregation_areas(client, region)
-        geom = None
-        geoms = [OGRGeometry(area['geom']) for area in region['aggregationareas']]
-        geom = geoms.pop()
-        for new_geom in geoms:
-            geom = geom.union(new_geom)
+        populate_aggregation_areas(client, region, workers=workers)
+        geoms = [GEOSGeometry(area['geom']) for area in region['aggregationareas']]
+        for geom in geoms:
+            geom.transform(WEB_MERCATOR_SRID)
+        # Merge all areas in a single cascaded union.
+        geom = OGRGeometry(GeometryCollection(*geoms, srid=WEB_MERCATOR_SRID).unary_union.wkt, WEB_MERCATOR_SRID)
     else:
         geom = OGRGeometry(region['geom'])
+        geom.transform(WEB_MERCATOR_SRID)
+
+    return geom
 
-    # Rasterize the resulting geometry.
-    geom_rst = rasterize(geom, result, all_touched=all_touched)
-    geom_mask = geom_rst.bands[0].data() == 0
-    # Use geom mask to change target data.
-    for band in result.bands:
-        band_data = band.data()
-        band_data[geom_mask] = const.NODATA_VALUE
-        band.data(band_data)
+
+def _geom_mask(geom, index_range, zoom, all_touched=False):
+    """
+    Rasterize the geometry over the index range, returns a boolean array that
+    is True for pixels inside the geometry.
+    """
+    origin, width, height, scale = _get_geotransform(index_range, zoom)
+    rst = GDALRaster({
+        'name': 'mask',
+        'driver': 'MEM',
+        'datatype': 1,
+        'origin': origin,
+        'width': width,
+        'height': height,
+        'srid': WEB_MERCATOR_SRID,
+        'scale': (scale, -scale),
+        'bands': [{'nodata_value': 0}],
+    })
+    return rasterize(geom, rst, all_touched=all_touched).bands[0].data() == 1
+
+
+def _tile_clipper(geom, inside, zoom, all_touched=False):
+    """
+    Create a function that sets the pixels of a tile that are outside of the
+    geometry to nodata. Tiles in the inside set are returned unchanged.
+    """
+    def clip(tile, data):
+        if data is None or tile in inside:
+            return data
+        data[:, ~_tile_mask(geom, tile, zoom, all_touched)] = const.NODATA_VALUE
+        return data
+
+    return clip
+
+
+def _tile_mask(geom, tile, zoom, all_touched=False):
+    """
+    Rasterize the geometry over the tile, returns a boolean array that is True
+    for pixels inside the geometry.
+    """
+    return _geom_mask(geom, tuple(tile) + tuple(tile), zoom, all_touched)
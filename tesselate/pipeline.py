@@ -0,0 +1,199 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+# Marker for the end of a stage input queue.
+_DONE = object()
+
+
+class StageStats(object):
+    """
+    Counters for a single pipeline stage.
+    """
+
+    def __init__(self, name, source=None):
+        self.name = name
+        # The queue feeding this stage, if any.
+        self.source = source
+        self.count = 0
+        self.busy = 0.0
+        self.max_queue_depth = 0
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def record(self, elapsed):
+        with self._lock:
+            self.count += 1
+            self.busy += elapsed
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    @property
+    def queue_depth(self):
+        return self.source.qsize() if self.source else 0
+
+    @property
+    def items_per_second(self):
+        if self.started is None:
+            return 0.0
+        elapsed = (self.finished or time.time()) - self.started
+        return self.count / elapsed if elapsed else 0.0
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'busy': self.busy,
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'items_per_second': self.items_per_second,
+        }
+
+
+class Pipeline(object):
+    """
+    Staged fetch, decode and write pipeline for exports.
+
+    Items are fetched in a pool of threads, decoded in a pool of processes and
+    written from the calling thread. The stages are connected by bounded
+    queues, so a slow stage blocks the stages upstream of it and memory stays
+    flat regardless of the number of items.
+
+    Pass an instance to export and inspect the stats after (or during) the run
+    to see which stage limits the throughput.
+    """
+
+    def __init__(self, fetch_workers=4, decode_workers=2, queue_size=32):
+        self.fetch_workers = fetch_workers
+        self.decode_workers = decode_workers
+        self.queue_size = queue_size
+        self.stages = OrderedDict()
+
+    def stats(self):
+        """
+        Get the per-stage counters as a dictionary.
+        """
+        return OrderedDict((name, stage.as_dict()) for name, stage in self.stages.items())
+
+    def run(self, items, fetch, decode, write):
+        """
+        Run all items through the pipeline. The decode function is executed in
+        a separate process and needs to be picklable.
+        """
+        items = iter(items)
+        items_lock = threading.Lock()
+        abort = threading.Event()
+        errors = []
+
+        fetched = queue.Queue(self.queue_size)
+        decoded = queue.Queue(self.queue_size)
+
+        self.stages = OrderedDict([
+            ('fetch', StageStats('fetch')),
+            ('decode', StageStats('decode', fetched)),
+            ('write', StageStats('write', decoded)),
+        ])
+        start = time.time()
+        for stage in self.stages.values():
+            stage.started = start
+
+        pool = ProcessPoolExecutor(max_workers=self.decode_workers)
+        # Start the decoding processes before any threads are running.
+        pool.submit(int).result()
+
+        def fetcher():
+            while not abort.is_set():
+                with items_lock:
+                    key = next(items, _DONE)
+                if key is _DONE:
+                    return
+                t0 = time.time()
+                payload = fetch(key)
+                self.stages['fetch'].record(time.time() - t0)
+                if not _put(fetched, (key, payload), abort):
+                    return
+
+        def decoder():
+            while True:
+                entry = _get(fetched, abort)
+                if entry is _DONE:
+                    return
+                key, payload = entry
+                t0 = time.time()
+                result = pool.submit(decode, payload).result()
+                self.stages['decode'].record(time.time() - t0)
+                if not _put(decoded, (key, result), abort):
+                    return
+
+        def guarded(target):
+            def wrapper():
+                try:
+                    target()
+                except Exception as e:
+                    errors.append(e)
+                    abort.set()
+            return wrapper
+
+        def coordinator(fetchers, decoders):
+            # Close each stage input queue once its upstream stage is done.
+            for thread in fetchers:
+                thread.join()
+            self.stages['fetch'].finished = time.time()
+            for thread in decoders:
+                _put(fetched, _DONE, abort)
+            for thread in decoders:
+                thread.join()
+            self.stages['decode'].finished = time.time()
+            _put(decoded, _DONE, abort)
+
+        fetchers = [threading.Thread(target=guarded(fetcher), daemon=True) for i in range(self.fetch_workers)]
+        decoders = [threading.Thread(target=guarded(decoder), daemon=True) for i in range(self.decode_workers)]
+        closer = threading.Thread(target=coordinator, args=(fetchers, decoders), daemon=True)
+        for thread in fetchers + decoders + [closer]:
+            thread.start()
+
+        try:
+            while True:
+                entry = _get(decoded, abort)
+                if entry is _DONE:
+                    break
+                t0 = time.time()
+                write(*entry)
+                self.stages['write'].record(time.time() - t0)
+        except Exception:
+            abort.set()
+            raise
+        finally:
+            closer.join()
+            pool.shutdown()
+            self.stages['write'].finished = time.time()
+
+        if errors:
+            raise errors[0]
+
+
+def _put(target, item, abort):
+    """
+    Put an item on a bounded queue, giving up if the pipeline was aborted.
+    """
+    while not abort.is_set():
+        try:
+            target.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(source, abort):
+    """
+    Get an item from a queue, returning the done marker if the pipeline was
+    aborted.
+    """
+    while not abort.is_set():
+        try:
+            return source.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _DONE
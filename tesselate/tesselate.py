@@ -2,10 +2,11 @@ import logging
 
 from django.conf import settings
 
-from tesselate.aggregation import aggregate, regional_aggregate
+from tesselate.aggregation import RegionalStats, aggregate, aggregate_many, regional_aggregate
 from tesselate.client import Client
-from tesselate.export import export
-from tesselate.tiles import pixel_from_coords
+from tesselate.export import export, iter_tiles
+from tesselate.tiles import pixel_from_coords, pixels_from_coords
+from tesselate.timeseries import timeseries
 from tesselate.training import ingest
 from tesselate.triggers import build, predict, train
 from tesselate.utils import z_scores_grouping
@@ -55,12 +56,18 @@ class Tesselate(object):
     def predictedlayer(self, id=None, **filters):
         return self.client.dispatch('predictedlayer', id=id, **filters)
 
-    def export(self, region, composite, formula, file_path, zoom=14, clip_to_geom=False, all_touched=False):
-        return export(self.client, region, composite, formula, file_path, zoom=zoom, clip_to_geom=clip_to_geom, all_touched=all_touched)
+    def export(self, region, composite, formula, file_path, zoom=14, clip_to_geom=False, all_touched=False, workers=None, pipeline=None, sparse=False, cog=False, compress='deflate', predictor=None, chunk_size=None, resume=False, out=None):
+        return export(self.client, region, composite, formula, file_path, zoom=zoom, clip_to_geom=clip_to_geom, all_touched=all_touched, workers=workers, pipeline=pipeline, sparse=sparse, cog=cog, compress=compress, predictor=predictor, chunk_size=chunk_size, resume=resume, out=out)
+
+    def iter_tiles(self, region, composite, formula, zoom=14, workers=None, ordered=True, sparse=False):
+        return iter_tiles(self.client, region, composite, formula, zoom=zoom, workers=workers, ordered=ordered, sparse=sparse)
 
     def aggregate(self, area, composite, formula, grouping='continuous', zoom=None, synchronous=True):
         return aggregate(self.client, area, composite, formula, grouping, zoom, synchronous)
 
+    def aggregate_many(self, areas, composite, formula, grouping='continuous', zoom=None, workers=None, poll_interval=1, max_poll_interval=30, timeout=None):
+        return aggregate_many(self.client, areas, composite, formula, grouping, zoom, workers, poll_interval, max_poll_interval, timeout)
+
     def build(self, compositebuild):
         return build(self.client, compositebuild)
 
@@ -73,11 +80,22 @@ class Tesselate(object):
     def regional_aggregate(self, valuecounts):
         return regional_aggregate(valuecounts)
 
+    def regional_stats(self, valuecounts=(), groups=None):
+        stats = RegionalStats()
+        stats.update(valuecounts, groups)
+        return stats
+
     def z_scores_grouping(self, mean, std):
         return z_scores_grouping(mean, std)
 
-    def ingest(self, classifier, scene, shapefile, class_column, valuemap, date_column=None, reset=False):
-        return ingest(self, classifier, scene, shapefile, class_column, valuemap, date_column, reset)
+    def ingest(self, classifier, scene, shapefile, class_column, valuemap, date_column=None, reset=False, workers=None, chunk_size=100, created=None, checkpoint=None, sync=False, reports=None):
+        return ingest(self, classifier, scene, shapefile, class_column, valuemap, date_column, reset, workers=workers, chunk_size=chunk_size, created=created, checkpoint=checkpoint, sync=sync, reports=reports)
 
     def pixel_from_coords(self, predictedlayer, coords):
         return pixel_from_coords(self.client, predictedlayer, coords)
+
+    def pixels_from_coords(self, layer, coords, zoom=14, formula=None, workers=None):
+        return pixels_from_coords(self.client, layer, coords, zoom=zoom, formula=formula, workers=workers)
+
+    def timeseries(self, composites, formula, coords=None, areas=None, zoom=14, workers=None):
+        return timeseries(self.client, composites, formula, coords=coords, areas=areas, zoom=zoom, workers=workers)
@@ -1,6 +1,12 @@
+import logging
 import urllib
 
-from tesselate.utils import layers_query_arg
+import numpy
+from django.contrib.gis.gdal import GDALException, GDALRaster
+from raster.tiles.const import WEB_MERCATOR_TILESHIFT, WEB_MERCATOR_TILESIZE
+from raster.tiles.utils import tile_scale
+
+from tesselate.utils import concurrent_map, layers_query_arg
 
 
 def algebra(client, tilez, tilex, tiley, composite, formula):
@@ -11,22 +17,132 @@ def algebra(client, tilez, tilex, tiley, composite, formula):
     # Consturct url.
     url = 'algebra/{}/{}/{}.tif?formula={}&layers={}'.format(tilez, tilex, tiley, formula_encoded, layers)
     # Fetch tile.
-    return client.get(url, json_response=False)
+    return _get_tile(client, url, tilez, tilex, tiley, formula_encoded, layers, 'tif')
 
 
 def rgb(client, tilez, tilex, tiley, composite):
-    # Construct url.
-    url = 'algebra/{}/{}/{}.png?layers=r={},g={},b={}&scale=0,4e3&alpha&enhance_brightness=1.6&enhance_sharpness=1.2&enhance_color=1.2&enhance_contrast=1.1'.format(
-        tilez,
-        tilex,
-        tiley,
+    # Construct layers lookup parameter.
+    layers = 'r={},g={},b={}'.format(
         composite['rasterlayer_lookup']['B04.jp2'],
         composite['rasterlayer_lookup']['B03.jp2'],
         composite['rasterlayer_lookup']['B02.jp2'],
     )
-    return client.get(url, json_response=False)
+    # Rendering options for the rgb image.
+    options = 'scale=0,4e3&alpha&enhance_brightness=1.6&enhance_sharpness=1.2&enhance_color=1.2&enhance_contrast=1.1'
+    # Construct url.
+    url = 'algebra/{}/{}/{}.png?layers={}&{}'.format(tilez, tilex, tiley, layers, options)
+    # Fetch tile.
+    return _get_tile(client, url, tilez, tilex, tiley, options, layers, 'png')
 
 
 def pixel_from_coords(client, predictedlayer, coords):
     url = 'pixel/{}/{}?formula=x&layers=x={}'.format(coords[0], coords[1], predictedlayer['rasterlayer'])
     return client.get(url)
+
+
+def layer_algebra(client, tilez, tilex, tiley, rasterlayer_id):
+    """
+    Fetch the algebra tile of a single rasterlayer, such as the rasterlayer of a
+    predictedlayer.
+    """
+    layers = 'x={}'.format(rasterlayer_id)
+    url = 'algebra/{}/{}/{}.tif?formula=x&layers={}'.format(tilez, tilex, tiley, layers)
+    return _get_tile(client, url, tilez, tilex, tiley, 'x', layers, 'tif')
+
+
+def tile_pixels(coords, zoom):
+    """
+    Compute the tile indices and the row and column within the tile for an
+    array of web mercator coordinates.
+    """
+    # Compute pixel indices on the global pixel grid of this zoom level.
+    scale = tile_scale(zoom)
+    pixelx = numpy.floor((coords[:, 0] + WEB_MERCATOR_TILESHIFT) / scale).astype('int64')
+    pixely = numpy.floor((WEB_MERCATOR_TILESHIFT - coords[:, 1]) / scale).astype('int64')
+
+    # Split into tile indices and pixel indices within the tile.
+    tilex, col = numpy.divmod(pixelx, WEB_MERCATOR_TILESIZE)
+    tiley, row = numpy.divmod(pixely, WEB_MERCATOR_TILESIZE)
+
+    return tilex, tiley, row, col
+
+
+def pixels_from_coords(client, layer, coords, zoom=14, formula=None, workers=None):
+    """
+    Get the pixel values for a list of coordinates in web mercator.
+
+    The layer is either a predictedlayer, or a composite if a formula is given.
+    The coordinates are grouped by the tile that contains them, every tile is
+    fetched once, and the values of all its coordinates are sampled locally.
+    Tiles are fetched concurrently if workers is larger than one.
+
+    Returns an array of values in the order of the input coordinates. The
+    values are nan for nodata pixels and for coordinates on tiles that can not
+    be decoded.
+    """
+    coords = numpy.asarray(coords, dtype='float64').reshape(-1, 2)
+    tilex, tiley, row, col = tile_pixels(coords, zoom)
+
+    # Group coordinates by tile.
+    tile_indices, selections = tile_groups(tilex, tiley)
+    logging.info('Sampling {} coordinates from {} tiles.'.format(len(coords), len(tile_indices)))
+
+    def fetch(tile):
+        if formula:
+            data = algebra(client, zoom, int(tile[0]), int(tile[1]), layer, formula)
+        else:
+            data = layer_algebra(client, zoom, int(tile[0]), int(tile[1]), layer['rasterlayer'])
+        return _read_tile(data)
+
+    result = numpy.full(len(coords), numpy.nan)
+    for selection, data in zip(selections, concurrent_map(fetch, tile_indices, workers=workers)):
+        if data is None:
+            continue
+        # Sample all coordinates of this tile at once.
+        result[selection] = data[row[selection], col[selection]]
+
+    return result
+
+
+def tile_groups(tilex, tiley):
+    """
+    Group pixels by tile. Returns the unique tile indices, and an array with
+    the indices of the pixels on each tile.
+    """
+    tile_indices, groups = numpy.unique(numpy.stack([tilex, tiley], axis=1), axis=0, return_inverse=True)
+    groups = groups.reshape(-1)
+    # Sort once and split at the group boundaries.
+    order = numpy.argsort(groups, kind='stable')
+    boundaries = numpy.cumsum(numpy.bincount(groups, minlength=len(tile_indices)))[:-1]
+    return tile_indices, numpy.split(order, boundaries)
+
+
+def _read_tile(data):
+    """
+    Decode an algebra tile into a float array with nan for nodata pixels.
+    Returns None if the tile can not be decoded.
+    """
+    try:
+        band = GDALRaster(data).bands[0]
+    except GDALException:
+        return
+    values = band.data().astype('float64')
+    if band.nodata_value is not None:
+        values[values == band.nodata_value] = numpy.nan
+    return values
+
+
+def _get_tile(client, url, tilez, tilex, tiley, formula, layers, extension):
+    """
+    Fetch a tile, using the client tile cache if it is enabled.
+    """
+    if client.tile_cache is None:
+        return client.get(url, json_response=False)
+
+    key = client.tile_cache.key(tilez, tilex, tiley, formula, layers, extension)
+    data = client.tile_cache.get(key)
+    if data is None:
+        data = client.get(url, json_response=False)
+        client.tile_cache.set(key, data)
+
+    return data
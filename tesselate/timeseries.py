@@ -0,0 +1,109 @@
+import logging
+from collections import OrderedDict
+
+import numpy
+from django.contrib.gis.gdal import OGRGeometry
+from raster.tiles.const import WEB_MERCATOR_SRID
+from raster.tiles.utils import tile_index_range
+
+from tesselate import tiles
+from tesselate.export import _intersecting_tiles, _tile_mask
+from tesselate.utils import concurrent_map, populate_aggregation_areas
+
+
+def timeseries(client, composites, formula, coords=None, areas=None, zoom=14, workers=None):
+    """
+    Extract the values of a formula over a list of composites.
+
+    The locations are either a list of coordinates in web mercator, or a list
+    of aggregation areas. For coordinates, the pixel values are extracted. For
+    areas, the mean of all pixels within the area geometry is computed,
+    excluding nodata pixels.
+
+    The tiles needed for all locations and composites are fetched once each,
+    concurrently if workers is larger than one. Returns an array with one row
+    per location and one column per composite. Values without data are nan.
+    """
+    if (coords is None) == (areas is None):
+        raise ValueError('Provide either coords or areas for the time series.')
+
+    # Collect the locations within each tile.
+    if coords is not None:
+        coords = numpy.asarray(coords, dtype='float64').reshape(-1, 2)
+        locations = _point_locations(coords, zoom)
+        count = len(coords)
+    else:
+        locations = _area_locations(client, areas, zoom, workers)
+        count = len(areas)
+
+    # Fetch tile by tile, with all composites of a tile in sequence.
+    plan = [(tile, index) for tile in locations for index in range(len(composites))]
+    logging.info('Extracting time series from {} tiles for {} composites.'.format(len(locations), len(composites)))
+
+    def fetch(item):
+        tile, index = item
+        return tiles._read_tile(tiles.algebra(client, zoom, tile[0], tile[1], composites[index], formula))
+
+    if coords is not None:
+        result = numpy.full((count, len(composites)), numpy.nan)
+    else:
+        # Sum and count of valid pixels per area.
+        sums = numpy.zeros((count, len(composites)))
+        counts = numpy.zeros((count, len(composites)))
+
+    masks = {}
+    for (tile, index), data in zip(plan, concurrent_map(fetch, plan, workers=workers)):
+        if data is None:
+            continue
+        if coords is not None:
+            # Sample all points of this tile at once.
+            indices, row, col = locations[tile]
+            result[indices, index] = data[row, col]
+            continue
+        # Compute the area masks only once per tile.
+        if tile not in masks:
+            masks = {tile: [(area, geom if geom is None else _tile_mask(geom, tile, zoom)) for area, geom in locations[tile]]}
+        for area, mask in masks[tile]:
+            values = data if mask is None else data[mask]
+            values = values[~numpy.isnan(values)]
+            sums[area, index] += values.sum()
+            counts[area, index] += values.size
+
+    if coords is None:
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            result = sums / counts
+
+    return result
+
+
+def _point_locations(coords, zoom):
+    """
+    Group the points by tile, returns the point indices and the rows and
+    columns of the points for each tile.
+    """
+    tilex, tiley, row, col = tiles.tile_pixels(coords, zoom)
+    locations = OrderedDict()
+    for tile, indices in zip(*tiles.tile_groups(tilex, tiley)):
+        locations[(int(tile[0]), int(tile[1]))] = (indices, row[indices], col[indices])
+    return locations
+
+
+def _area_locations(client, areas, zoom, workers=None):
+    """
+    Group the areas by the tiles they overlap with, tiles that only touch an
+    area are skipped. For each tile, returns the area indices together with the
+    area geometry, or None if the tile is fully within the area.
+    """
+    # Get area objects if ids were provided.
+    region = {'aggregationareas': list(areas)}
+    populate_aggregation_areas(client, region, workers=workers)
+
+    locations = {}
+    for area_index, area in enumerate(region['aggregationareas']):
+        geom = OGRGeometry(area['geom'])
+        geom.transform(WEB_MERCATOR_SRID)
+        inside = set()
+        for tile in _intersecting_tiles(geom, tile_index_range(geom.extent, zoom), zoom, inside):
+            locations.setdefault(tile, []).append((area_index, None if tile in inside else geom))
+
+    return OrderedDict(sorted(locations.items()))
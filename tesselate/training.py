@@ -1,11 +1,16 @@
+import hashlib
+import itertools
+import json
 import logging
+import os
 
-from django.contrib.gis.gdal import DataSource
+import requests
+from django.contrib.gis.gdal import DataSource, OGRGeometry
 
-from tesselate.utils import confirm
+from tesselate.utils import concurrent_map, confirm
 
 
-def ingest(ts, traininglayer, image, shapefile, class_column, valuemap, date_column, reset):
+def ingest(ts, traininglayer, image, shapefile, class_column, valuemap, date_column, reset, workers=None, chunk_size=100, created=None, checkpoint=None, sync=False, reports=None):
     """
     Upload trainingsamples from a shapefile.
 
@@ -14,6 +19,23 @@ def ingest(ts, traininglayer, image, shapefile, class_column, valuemap, date_col
     values as integers. If the valuemap is empty, continous mode is assumed.
 
     The image is either a sentineltile or a composite.
+
+    The samples are uploaded in chunks of chunk_size samples, using the given
+    number of concurrent workers. If a created dict is passed, it is updated
+    with the feature index and id of every created sample. Passing the same
+    dict again after a partial failure only uploads the missing samples.
+
+    Features are read and uploaded as a stream. If a checkpoint file path is
+    given, the index and id of created samples are recorded in that file, and
+    a rerun with the same checkpoint resumes where the previous run stopped.
+
+    In sync mode, the features are compared to the samples that already exist
+    in the traininglayer, and only the differences are created, updated or
+    deleted. Sync mode can not be combined with a created dict or checkpoint,
+    running it again already skips the samples that exist.
+
+    If a reports list is passed, the upload report of every chunk is appended
+    to it, see the upload function for the report format.
     """
     # Check consistency.
     continuous = traininglayer.get('continuous', False)
@@ -21,18 +43,22 @@ def ingest(ts, traininglayer, image, shapefile, class_column, valuemap, date_col
         raise ValueError('Leave valuemap empty for continuous layers.')
     elif not valuemap and not continuous:
         raise ValueError('Provide valuemap for discrete layers.')
+    if sync and reset:
+        raise ValueError('Reset and sync can not be used simultaneously.')
+    if sync and (created is not None or checkpoint):
+        raise ValueError('The created dict and checkpoint are not available in sync mode.')
 
     # Delete current training samples.
     if reset and confirm('delete all {} exsiting training sample in this layer.'.format(len(traininglayer['trainingsamples']))):
         for sample_id in traininglayer['trainingsamples']:
             ts.trainingsample(id=sample_id, delete=True, force=True)
         traininglayer['trainingsamples'] = []
+        # Samples from previous runs are gone.
+        if created:
+            created.clear()
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
 
-    # Decide if layer input is a scene or a composite.
-    if 'interval' in image:
-        image_key = 'composite'
-    else:
-        image_key = 'sentineltile'
     # Open data source.
     ds = DataSource(shapefile)
     # Get layer from data source.
@@ -42,14 +68,55 @@ def ingest(ts, traininglayer, image, shapefile, class_column, valuemap, date_col
         raise ValueError('Class column "{}" not found in data source.'.format(class_column))
     if date_column and date_column not in lyr.fields:
         raise ValueError('Date column "{}" not found in data source.'.format(date_column))
-    # Create empty training data list.
-    trainings = []
-    # Get training data from layer.
+    # Check feature types before uploading anything.
     for feat in lyr:
-        # Check feature type.
         if feat.geom.geom_name != 'POLYGON':
             raise ValueError('Geometry type must be polygon, found {}.'.format(feat.geom.geom_name))
 
+    if sync:
+        trainings = _read_trainings(lyr, traininglayer, image, class_column, valuemap, date_column)
+        return _sync(ts, traininglayer, trainings, workers=workers, chunk_size=chunk_size, reports=reports)
+
+    # Load created samples from a previous run.
+    if created is None:
+        created = {}
+    if checkpoint:
+        created.update(read_checkpoint(checkpoint, traininglayer))
+
+    # Ask for confirmation before posting the data.
+    if not confirm('create {} new training samples for traininglayer {}.'.format(len(lyr) - len(created), traininglayer['id'])):
+        return
+
+    # Read and post training data as a stream.
+    trainings = _read_trainings(lyr, traininglayer, image, class_column, valuemap, date_column)
+    chunk_reports = upload(ts, traininglayer, trainings, workers=workers, chunk_size=chunk_size, created=created, checkpoint=checkpoint)
+    if reports is not None:
+        reports.extend(chunk_reports)
+
+    failed = sum(len(report['failed']) for report in chunk_reports)
+    if failed:
+        logging.warning('Failed to upload {} samples, run ingest again with the same {} to retry.'.format(
+            failed,
+            'checkpoint' if checkpoint else 'created dict',
+        ))
+
+    return traininglayer
+
+
+def _read_trainings(lyr, traininglayer, image, class_column, valuemap, date_column):
+    """
+    Generator that converts the features of the layer into training samples.
+    """
+    continuous = traininglayer.get('continuous', False)
+
+    # Decide if layer input is a scene or a composite.
+    if 'interval' in image:
+        image_key = 'composite'
+    else:
+        image_key = 'sentineltile'
+
+    # Get training data from layer.
+    for feat in lyr:
         # Collect attributes.
         attributes = {field: str(feat.get(field)) for field in lyr.fields if field not in [class_column, date_column]}
 
@@ -74,7 +141,7 @@ def ingest(ts, traininglayer, image, shapefile, class_column, valuemap, date_col
         else:
             date = ''
 
-        trainings.append({
+        yield {
             'traininglayer': traininglayer['id'],
             'category': category,
             'value': category_value,
@@ -82,19 +149,208 @@ def ingest(ts, traininglayer, image, shapefile, class_column, valuemap, date_col
             'date': date,
             image_key: image['id'],
             'attributes': attributes,
-        })
+        }
 
-    # Ask for confirmation before posting the data.
-    if not confirm('create {} new training samples for traininglayer {}.'.format(len(trainings), traininglayer['id'])):
+
+def _sync(ts, traininglayer, trainings, workers=None, chunk_size=100, reports=None):
+    """
+    Update the samples of the traininglayer to match the input trainings.
+
+    Samples are matched by their geometry. Matched samples are updated if
+    their class, value, date or attributes differ, unmatched trainings are
+    created and unmatched samples are deleted.
+    """
+    # Index existing samples by geometry.
+    existing = {}
+    for sample in ts.trainingsample(traininglayer=traininglayer['id'], all_pages=True):
+        existing.setdefault(_geometry_hash(sample['geom']), []).append(sample)
+
+    # Compare trainings against existing samples.
+    creates = []
+    updates = []
+    unchanged = 0
+    for training in trainings:
+        matches = existing.get(_geometry_hash(training['geom']), [])
+        if not matches:
+            creates.append(training)
+            continue
+        sample = matches.pop()
+        if _fingerprint(sample) == _fingerprint(training):
+            unchanged += 1
+        else:
+            updates.append(dict(training, id=sample['id']))
+    deletes = [sample['id'] for samples in existing.values() for sample in samples]
+
+    logging.info('Found {} unchanged training samples.'.format(unchanged))
+
+    if not (creates or updates or deletes):
+        return traininglayer
+
+    # Ask for confirmation before changing the data.
+    if not confirm('create {}, update {} and delete {} training samples for traininglayer {}.'.format(
+            len(creates), len(updates), len(deletes), traininglayer['id'])):
         return
 
-    # Post training data.
-    for index, training in enumerate(trainings):
-        response = ts.trainingsample(data=training)
-        # Add new training sample to local traininglayer object to keep it in
-        # sync with the database.
-        traininglayer['trainingsamples'].append(response['id'])
+    # Delete samples that are not in the input anymore.
+    def delete(sample_id):
+        ts.trainingsample(id=sample_id, delete=True, force=True)
+        return sample_id
+
+    for sample_id in concurrent_map(delete, deletes, workers=workers):
+        if sample_id in traininglayer['trainingsamples']:
+            traininglayer['trainingsamples'].remove(sample_id)
+
+    # Update changed samples.
+    for index, update in enumerate(concurrent_map(lambda update: ts.trainingsample(data=update), updates, workers=workers)):
         if index % 100 == 0:
-            logging.info('Processed {}/{} samples.'.format(index + 1, len(trainings)))
+            logging.info('Updated {}/{} samples.'.format(index + 1, len(updates)))
+
+    # Create new samples.
+    chunk_reports = upload(ts, traininglayer, creates, workers=workers, chunk_size=chunk_size)
+    if reports is not None:
+        reports.extend(chunk_reports)
+
+    failed = sum(len(report['failed']) for report in chunk_reports)
+    if failed:
+        logging.warning('Failed to upload {} samples, run ingest again in sync mode to retry.'.format(failed))
 
     return traininglayer
+
+
+def _geometry_hash(geom):
+    """
+    Hash a geometry independently of its projection and text representation.
+    """
+    if isinstance(geom, dict):
+        geom = json.dumps(geom)
+    geom = OGRGeometry(geom)
+    geom.transform(4326)
+    # Round coordinates to avoid mismatches from reprojection precision.
+    return hashlib.sha1(json.dumps(_round(geom.coords)).encode()).hexdigest()
+
+
+def _round(coords, precision=7):
+    if isinstance(coords, (tuple, list)):
+        return [_round(coord, precision) for coord in coords]
+    return round(coords, precision)
+
+
+def _fingerprint(sample):
+    """
+    Hash the geometry, class, value, date and attributes of a sample.
+    """
+    attributes = sample.get('attributes') or {}
+    if isinstance(attributes, str):
+        attributes = json.loads(attributes)
+    return hashlib.sha1(json.dumps([
+        _geometry_hash(sample['geom']),
+        sample.get('category') or '',
+        float(sample['value']),
+        str(sample.get('date') or ''),
+        attributes,
+    ], sort_keys=True).encode()).hexdigest()
+
+
+def read_checkpoint(checkpoint, traininglayer):
+    """
+    Read the feature index to sample id map from an ingest checkpoint file.
+    """
+    created = {}
+    if not os.path.exists(checkpoint):
+        return created
+
+    with open(checkpoint, 'r') as fl:
+        header = json.loads(fl.readline())
+        if header['traininglayer'] != traininglayer['id']:
+            raise ValueError('Checkpoint {} belongs to traininglayer {}.'.format(checkpoint, header['traininglayer']))
+        for line in fl:
+            # Ignore incomplete lines from interrupted writes.
+            try:
+                index, sample_id = json.loads(line)
+            except ValueError:
+                continue
+            created[index] = sample_id
+
+    logging.info('Found {} created samples in checkpoint.'.format(len(created)))
+
+    return created
+
+
+def _write_checkpoint(checkpoint, traininglayer, entries):
+    """
+    Append feature index and sample id pairs to the checkpoint file.
+    """
+    new = not os.path.exists(checkpoint)
+    with open(checkpoint, 'a') as fl:
+        if new:
+            fl.write(json.dumps({'traininglayer': traininglayer['id']}) + '\n')
+        for entry in entries:
+            fl.write(json.dumps(entry) + '\n')
+        fl.flush()
+        os.fsync(fl.fileno())
+
+
+def upload(ts, traininglayer, trainings, workers=None, chunk_size=100, created=None, checkpoint=None):
+    """
+    Post training samples to the api in chunks.
+
+    The samples within a chunk are posted concurrently if workers is larger
+    than one. Samples whose index is a key in the created dict are skipped, all
+    new samples are added to it. The ids of new samples are appended to the
+    traininglayer in input order of this run, so samples created in a retry
+    come after the samples of previous runs. The created dict maps feature
+    indices to ids for the full input order. If a checkpoint path is given, the
+    new samples are appended to the checkpoint file after each chunk.
+
+    Returns a list of reports with the number of created, skipped and failed
+    samples for each chunk.
+    """
+    if created is None:
+        created = {}
+
+    def post(entry):
+        index, training = entry
+        try:
+            return index, ts.trainingsample(data=training)['id'], None
+        except requests.exceptions.RequestException as e:
+            return index, None, e
+
+    reports = []
+    samples = enumerate(trainings)
+    for chunk_index in itertools.count():
+        chunk = list(itertools.islice(samples, chunk_size))
+        if not chunk:
+            break
+
+        pending = [entry for entry in chunk if entry[0] not in created]
+        report = {
+            'chunk': chunk_index,
+            'start': chunk[0][0],
+            'stop': chunk[-1][0] + 1,
+            'created': 0,
+            'skipped': len(chunk) - len(pending),
+            'failed': [],
+        }
+        new = []
+        for index, sample_id, error in concurrent_map(post, pending, workers=workers):
+            if error:
+                logging.error('Failed to upload sample {}: {}'.format(index, error))
+                report['failed'].append(index)
+            else:
+                created[index] = sample_id
+                new.append((index, sample_id))
+                report['created'] += 1
+                # Add new training sample to local traininglayer object to keep
+                # it in sync with the database.
+                traininglayer['trainingsamples'].append(sample_id)
+
+        if checkpoint and new:
+            _write_checkpoint(checkpoint, traininglayer, new)
+
+        logging.info('Processed samples {start}-{stop}: {created} created, {skipped} skipped, {failed_count} failed.'.format(
+            failed_count=len(report['failed']),
+            **report
+        ))
+        reports.append(report)
+
+    return reports
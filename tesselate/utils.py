@@ -1,4 +1,7 @@
+import logging
 import sys
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 
 from tesselate import const
 
@@ -51,11 +54,81 @@ def z_scores_grouping(mean, std):
     ]
 
 
-def populate_aggregation_areas(client, region):
+def populate_aggregation_areas(client, region, batch_size=100, workers=None, fields=None):
     """
     Request aggregation area objects from api and store them in the region dict.
+
+    The areas are requested in batches of batch_size ids using the id__in list
+    filter. If the api does not apply the filter, the remaining areas are
+    requested one by one, concurrently if workers is larger than one. The
+    optional fields list limits the data requested for each area.
     """
+    # Only get the data if the area is indeed a primary key integer.
+    ids = [id for id in region['aggregationareas'] if isinstance(id, int)]
+
+    query = {}
+    if fields:
+        query['fields'] = ','.join(['id'] + [field for field in fields if field != 'id'])
+
+    areas = {}
+    if batch_size:
+        for start in range(0, len(ids), batch_size):
+            batch = set(ids[start:start + batch_size])
+            supported = True
+            for area in client.dispatch('aggregationarea', all_pages=True, id__in=','.join(str(id) for id in sorted(batch)), **query):
+                # Stop if the response contains areas that were not requested.
+                if area['id'] not in batch:
+                    supported = False
+                    break
+                areas[area['id']] = area
+            if not supported:
+                logging.debug('List filter by id not available, requesting areas individually.')
+                break
+
+    # Request missing areas one by one.
+    missing = [id for id in ids if id not in areas]
+    for id, area in zip(missing, concurrent_map(lambda id: client.dispatch('aggregationarea', id=id, **query), missing, workers=workers)):
+        areas[id] = area
+
     for index, id in enumerate(region['aggregationareas']):
-        # Only get the data if the area is indeed a primary key integer.
         if isinstance(id, int):
-            region['aggregationareas'][index] = client.dispatch('aggregationarea', id=id)
+            region['aggregationareas'][index] = areas[id]
+
+
+def concurrent_map(func, iterable, workers=None, ordered=True):
+    """
+    Apply func to every item of the iterable, yielding the results in input
+    order by default.
+
+    If workers is larger than one, the calls are run in a thread pool. At most
+    twice as many calls as workers are in flight at any time, so the input is
+    consumed lazily and memory stays bounded for long iterables. If ordered is
+    False, results are yielded as soon as they are ready.
+    """
+    if not workers or workers < 2:
+        for item in iterable:
+            yield func(item)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        if not ordered:
+            pending = set()
+            for item in iterable:
+                pending.add(executor.submit(func, item))
+                # Wait for any call once the window is full.
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            for future in as_completed(pending):
+                yield future.result()
+            return
+
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            # Wait for the oldest call once the window is full.
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
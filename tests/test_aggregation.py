@@ -0,0 +1,147 @@
+import asyncio
+import itertools
+import os
+import re
+import unittest
+
+import mock
+import numpy
+
+from tesselate import Tesselate, const
+from tesselate.aio import AsyncTesselate
+from tests.utils import TesselateMockResponseBase
+
+
+class TestTesselateAggregateMany(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['TESSELO_ACCESS_TOKEN'] = 'tesselate test token env'
+        self.ts = Tesselate()
+        self.composite = {'id': 1, 'name': 'March', 'rasterlayer_lookup': {'B04.jp2': 1, 'B08.jp2': 2}}
+        self.formula = {'id': 1, 'name': 'NDVI', 'acronym': 'NDVI', 'formula': '(B8 - B4) / (B8 + B4)'}
+        # Area 1 is cached, area 2 finishes after two polls, area 3 fails.
+        self.polls = {}
+        self.statuses = {
+            102: ['Computing', const.VALUECOUNT_FINISHED],
+            103: [const.VALUECOUNT_FAILED],
+        }
+
+    def mock_get(self, session, url):
+        match = re.search(r'valuecountresult/(\d+)', url)
+        if match:
+            # Return the next status of the result.
+            result_id = int(match.group(1))
+            self.polls[result_id] = self.polls.get(result_id, 0) + 1
+            data = {'id': result_id, 'status': self.statuses[result_id].pop(0)}
+        elif 'aggregationarea=1&' in url:
+            data = [{'id': 101, 'status': const.VALUECOUNT_FINISHED}]
+        else:
+            data = []
+
+        class MockResponse(TesselateMockResponseBase):
+
+            def json(self):
+                return data
+
+        return MockResponse()
+
+    def mock_post(self, session, url, json):
+        self.assertNotIn('synchronous', url)
+
+        class MockResponse(TesselateMockResponseBase):
+
+            def json(self):
+                return {'id': 100 + json['aggregationarea'], 'status': 'Scheduled'}
+
+        return MockResponse()
+
+    @mock.patch('tesselate.aggregation.time.sleep')
+    def test_aggregate_many(self, sleep):
+        areas = [{'id': 1}, {'id': 2}, 3]
+        with mock.patch('tesselate.client.requests.Session.get', autospec=True, side_effect=self.mock_get), \
+                mock.patch('tesselate.client.requests.Session.post', autospec=True, side_effect=self.mock_post) as post:
+            results = self.ts.aggregate_many(areas, self.composite, self.formula, workers=3)
+        # Only the missing results are requested.
+        self.assertEqual(post.call_count, 2)
+        self.assertEqual(results, {
+            1: {'id': 101, 'status': const.VALUECOUNT_FINISHED},
+            2: {'id': 102, 'status': const.VALUECOUNT_FINISHED},
+            3: None,
+        })
+        self.assertEqual(self.polls, {102: 2, 103: 1})
+        # The poll interval grows exponentially.
+        self.assertEqual([call[0][0] for call in sleep.call_args_list], [1, 2])
+
+    @mock.patch('tesselate.aio.asyncio.sleep', new_callable=mock.AsyncMock)
+    @mock.patch('tesselate.aggregation.time.sleep')
+    def test_aggregate_many_async(self, sleep, async_sleep):
+        ts = AsyncTesselate(concurrency=2)
+        with mock.patch('tesselate.client.requests.Session.get', autospec=True, side_effect=self.mock_get), \
+                mock.patch('tesselate.client.requests.Session.post', autospec=True, side_effect=self.mock_post) as post:
+            results = asyncio.run(ts.aggregate_many([{'id': 1}, 2, 3], self.composite, self.formula))
+        ts.client.close()
+        self.assertEqual(post.call_count, 2)
+        self.assertEqual(results[2], {'id': 102, 'status': const.VALUECOUNT_FINISHED})
+        self.assertIsNone(results[3])
+        # Polling waits on the event loop instead of blocking a thread.
+        self.assertFalse(sleep.called)
+        self.assertEqual([call[0][0] for call in async_sleep.call_args_list], [1, 2])
+
+    @mock.patch('tesselate.aggregation.time.sleep')
+    def test_aggregate_many_timeout(self, sleep):
+        self.statuses[102] = ['Computing'] * 10
+        with mock.patch('tesselate.client.requests.Session.get', autospec=True, side_effect=self.mock_get), \
+                mock.patch('tesselate.client.requests.Session.post', autospec=True, side_effect=self.mock_post), \
+                mock.patch('tesselate.aggregation.time.time', side_effect=itertools.count()):
+            results = self.ts.aggregate_many([2], self.composite, self.formula, timeout=5)
+        self.assertEqual(results, {2: None})
+        self.assertLess(self.polls[102], 5)
+
+
+class TestTesselateRegionalStats(unittest.TestCase):
+
+    def valuecount(self, values):
+        values = numpy.asarray(values, dtype='float64')
+        return {
+            'pcount': len(values),
+            'psum': values.sum(),
+            'psumsq': (values ** 2).sum(),
+            'min': values.min(),
+            'max': values.max(),
+        }
+
+    def setUp(self):
+        self.ts = Tesselate()
+        # Large offset to expose cancellation in the raw sum of squares.
+        random = numpy.random.RandomState(23)
+        self.areas = [1e4 + random.normal(size=random.randint(10, 100)) for i in range(20)]
+        self.valuecounts = [self.valuecount(values) for values in self.areas]
+
+    def test_regional_aggregate(self):
+        values = numpy.concatenate(self.areas)
+        result = self.ts.regional_aggregate(self.valuecounts + [{'pcount': 0, 'psum': 0, 'psumsq': 0, 'min': None, 'max': None}])
+        self.assertAlmostEqual(result['mean'], values.mean())
+        self.assertAlmostEqual(result['std'], values.std(), places=5)
+        self.assertEqual(result['min'], values.min())
+        self.assertEqual(result['max'], values.max())
+
+    def test_regional_aggregate_empty(self):
+        self.assertEqual(self.ts.regional_aggregate([]), {'min': None, 'max': None, 'std': None, 'mean': None})
+
+    def test_regional_stats_groups_and_merge(self):
+        groups = ['north' if index % 3 else 'south' for index in range(len(self.areas))]
+        # Accumulate the two halves separately and merge.
+        stats = self.ts.regional_stats(self.valuecounts[:7], groups[:7])
+        stats.merge(self.ts.regional_stats(self.valuecounts[7:], groups[7:]))
+        results = stats.results()
+        self.assertEqual(set(results), {'north', 'south'})
+        for group, result in results.items():
+            values = numpy.concatenate([area for area, key in zip(self.areas, groups) if key == group])
+            self.assertAlmostEqual(result['mean'], values.mean())
+            self.assertAlmostEqual(result['std'], values.std(), places=5)
+            self.assertEqual(result['max'], values.max())
+        self.assertEqual(stats.result('east')['mean'], None)
+
+    def test_regional_stats_group_count(self):
+        with self.assertRaises(ValueError):
+            self.ts.regional_stats(self.valuecounts, groups=['north'])
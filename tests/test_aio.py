@@ -0,0 +1,75 @@
+import asyncio
+import os
+import unittest
+
+import mock
+import numpy
+import requests
+
+from tesselate import Tesselate
+from tesselate.aio import AsyncTesselate
+from tests.test_client_dispatch import mock_get_formula_detail, mock_get_scene_pages
+from tests.test_export import mock_get_algebra
+
+
+class TestTesselateAsync(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['TESSELO_ACCESS_TOKEN'] = 'tesselate test token env'
+        self.ts = AsyncTesselate(concurrency=4)
+
+    def tearDown(self):
+        self.ts.client.close()
+
+    @mock.patch('tesselate.client.requests.Session.get', mock_get_formula_detail)
+    def test_dispatch(self):
+        async def run():
+            return await asyncio.gather(*[self.ts.formula(id=36) for i in range(10)])
+
+        for response in asyncio.run(run()):
+            self.assertEqual(response['acronym'], 'CI')
+
+    @mock.patch('tesselate.client.requests.Session.get', mock_get_scene_pages)
+    def test_iterate(self):
+        async def run():
+            return [scene['id'] async for scene in self.ts.client.iterate('sentineltile', batch_size=2)]
+
+        self.assertEqual(asyncio.run(run()), list(range(7)))
+
+    def test_all_pages(self):
+        with self.assertRaises(ValueError):
+            asyncio.run(self.ts.scene(all_pages=True))
+
+    @mock.patch('tesselate.client.requests.Session.get', mock_get_algebra)
+    def test_export(self):
+        region = {'id': 1, 'name': 'Lisbon', 'extent': [-9.3, 38.6, -9.0, 38.95]}
+        composite = {'id': 1, 'name': 'March', 'rasterlayer_lookup': {'B04.jp2': 1, 'B08.jp2': 2}}
+        formula = {'id': 1, 'name': 'NDVI', 'acronym': 'NDVI', 'formula': '(B8 - B4) / (B8 + B4)'}
+        result = asyncio.run(self.ts.export(region, composite, formula, None, zoom=10))
+        expected = Tesselate().export(region, composite, formula, None, zoom=10)
+        numpy.testing.assert_array_equal(result, expected)
+
+    def test_export_failure_cancels_tiles(self):
+        region = {'id': 1, 'name': 'Lisbon', 'extent': [-9.3, 38.6, -9.0, 38.95]}
+        composite = {'id': 1, 'name': 'March', 'rasterlayer_lookup': {'B04.jp2': 1, 'B08.jp2': 2}}
+        formula = {'id': 1, 'name': 'NDVI', 'acronym': 'NDVI', 'formula': '(B8 - B4) / (B8 + B4)'}
+        calls = []
+
+        def failing_get(session, url):
+            calls.append(url)
+            if len(calls) == 3:
+                raise requests.exceptions.ConnectionError('Connection reset.')
+            return mock_get_algebra(session, url)
+
+        async def run():
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                await self.ts.export(region, composite, formula, None, zoom=12)
+            count = len(calls)
+            # No tiles are fetched after the export failed.
+            await asyncio.sleep(0.2)
+            return count
+
+        with mock.patch('tesselate.client.requests.Session.get', autospec=True, side_effect=failing_get):
+            count = asyncio.run(run())
+        self.assertEqual(len(calls), count)
+        self.assertLess(count, 20)
@@ -2,11 +2,12 @@ import os
 import unittest
 
 import mock
+import requests
 
 from tesselate import Tesselate
 
 
-def mock_authenticate(url, data):
+def mock_authenticate(session, url, data, headers):
 
     class MockAuthResponse(object):
 
@@ -33,9 +34,39 @@ class TestTesselateClientAuth(unittest.TestCase):
         self.assertEqual(self.ts.client.token, 'tesselate test token set')
         self.assertEqual(self.ts.client.session.headers['Authorization'], 'Token tesselate test token set')
 
-    @mock.patch('tesselate.client.requests.post', mock_authenticate)
     def test_authenticate(self):
-        self.ts.client.authenticate('lucille', 'shawnparmegian')
+        session = self.ts.client.session
+        with mock.patch('tesselate.client.requests.Session.post', autospec=True, side_effect=mock_authenticate) as post:
+            self.ts.client.authenticate('lucille', 'shawnparmegian')
         self.assertEqual(self.ts.client.token, 'tesselate test token api')
         self.assertEqual(self.ts.client._username, 'lucille')
         self.assertEqual(self.ts.client._token_expires, '1953')
+        # The old token is not sent to the auth endpoint.
+        self.assertEqual(post.call_args[1]['headers'], {'Authorization': None})
+        # The session and its connection pool are kept.
+        self.assertIs(self.ts.client.session, session)
+        self.assertEqual(self.ts.client.session.headers['Authorization'], 'Token tesselate test token api')
+
+    @mock.patch.dict(os.environ, clear=True)
+    def test_session_without_token(self):
+        ts = Tesselate()
+        self.assertNotIn('Authorization', ts.client.session.headers)
+        ts.client.set_token('tesselate test token set')
+        self.assertEqual(ts.client.session.headers['Authorization'], 'Token tesselate test token set')
+
+    def test_pool_options(self):
+        self.ts.client.set_pool_options(pool_maxsize=32, pool_block=True, timeout=(3, 30), keep_alive=False)
+        adapter = self.ts.client.session.get_adapter(self.ts.client.api)
+        self.assertEqual(adapter._pool_maxsize, 32)
+        self.assertTrue(adapter._pool_block)
+        self.assertEqual(adapter.timeout, (3, 30))
+        self.assertEqual(self.ts.client.session.headers['Connection'], 'close')
+        # The token survives pool changes.
+        self.assertEqual(self.ts.client.session.headers['Authorization'], 'Token tesselate test token env')
+
+        response = requests.Response()
+        response.status_code = 200
+        response._content = b'{}'
+        with mock.patch('requests.adapters.HTTPAdapter.send', return_value=response) as send:
+            self.ts.client.get('formula')
+        self.assertEqual(send.call_args[1]['timeout'], (3, 30))
@@ -70,6 +70,22 @@ def mock_update_formula(session, url, json):
     return MockResponse()
 
 
+def mock_get_scene_pages(session, url):
+
+    class MockResponse(TesselateMockResponseBase):
+
+        def json(self):
+            page = int(url.split('page=')[1]) if 'page=' in url else 1
+            return {
+                'count': 7,
+                'next': 'https://api.tesselo.com/sentineltile?cloudy_pixel_percentage__lt=10&page={}'.format(page + 1) if page < 3 else None,
+                'previous': None,
+                'results': [{'id': idx} for idx in range(3 * (page - 1), min(3 * page, 7))],
+            }
+
+    return MockResponse()
+
+
 def mock_delete_formula(session, url):
 
     return TesselateMockResponseBase()
@@ -118,3 +134,22 @@ class TestTesselateClient(unittest.TestCase):
     def test_delete_formula_no(self):
         response = self.ts.formula(id=36, delete=True)
         self.assertIsNone(response)
+
+    def test_get_all_pages(self):
+        for prefetch in (True, False):
+            with mock.patch('tesselate.client.requests.Session.get', side_effect=mock_get_scene_pages, autospec=True) as get:
+                response = self.ts.scene(cloudy_pixel_percentage__lt=10, all_pages=True, prefetch=prefetch)
+                # Pages are only requested when consumed.
+                self.assertEqual(get.call_count, 0)
+                self.assertEqual(next(response), {'id': 0})
+                self.assertEqual([scene['id'] for scene in response], [1, 2, 3, 4, 5, 6])
+                self.assertEqual(get.call_count, 3)
+                self.assertEqual(get.call_args_list[0][0][1], 'https://api.tesselo.com/sentineltile?cloudy_pixel_percentage__lt=10')
+
+    @mock.patch('tesselate.client.requests.Session.get', mock_get_scene_pages)
+    def test_iterate(self):
+        self.assertEqual(len(list(self.ts.client.iterate('sentineltile'))), 7)
+
+    def test_all_pages_detail(self):
+        with self.assertRaises(ValueError):
+            self.ts.scene(id=1, all_pages=True)
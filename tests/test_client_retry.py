@@ -0,0 +1,107 @@
+import os
+import threading
+import unittest
+
+import mock
+import requests
+
+from tesselate import Tesselate
+from tesselate.client import TokenBucket
+from tests.utils import response
+
+
+@mock.patch('tesselate.client.time.sleep')
+class TestTesselateClientRetry(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['TESSELO_ACCESS_TOKEN'] = 'tesselate test token env'
+        self.ts = Tesselate()
+        self.ts.client.set_retry_policy(retries=3, backoff_factor=1, max_backoff=10)
+
+    def test_no_retry_by_default(self, sleep):
+        self.ts.client.set_retry_policy(retries=0)
+        with mock.patch('tesselate.client.requests.Session.get', side_effect=[response(503), response(200)]):
+            with self.assertRaises(requests.exceptions.HTTPError):
+                self.ts.formula(id=1)
+
+    def test_retry_get(self, sleep):
+        responses = [response(503), requests.exceptions.ConnectionError(), response(200, b'{"id": 1}')]
+        with mock.patch('tesselate.client.requests.Session.get', side_effect=responses) as get:
+            self.assertEqual(self.ts.formula(id=1), {'id': 1})
+        self.assertEqual(get.call_count, 3)
+        self.assertEqual(self.ts.client.metrics['retries'], 2)
+        self.assertEqual(self.ts.client.metrics['requests'], 3)
+        # Backoff is exponential with jitter.
+        self.assertLessEqual(sleep.call_args_list[0][0][0], 1)
+        self.assertLessEqual(sleep.call_args_list[1][0][0], 2)
+
+    def test_retry_exhausted(self, sleep):
+        with mock.patch('tesselate.client.requests.Session.get', return_value=response(502)) as get:
+            with self.assertRaises(requests.exceptions.HTTPError):
+                self.ts.formula(id=1)
+        self.assertEqual(get.call_count, 4)
+
+    def test_retry_after(self, sleep):
+        with mock.patch('tesselate.client.requests.Session.get', side_effect=[response(429, headers={'Retry-After': '7'}), response(200)]):
+            self.ts.formula(id=1)
+        sleep.assert_called_once_with(7.0)
+        self.assertEqual(self.ts.client.metrics['rate_limited'], 1)
+
+    def test_retry_after_capped(self, sleep):
+        with mock.patch('tesselate.client.requests.Session.get', side_effect=[response(503, headers={'Retry-After': '3600'}), response(200)]):
+            self.ts.formula(id=1)
+        sleep.assert_called_once_with(10)
+
+    def test_retry_after_invalid(self, sleep):
+        with mock.patch('tesselate.client.requests.Session.get', side_effect=[response(503, headers={'Retry-After': 'soon'}), response(200)]):
+            self.ts.formula(id=1)
+        # Falls back to the jittered backoff.
+        self.assertLessEqual(sleep.call_args[0][0], 1)
+
+    def test_raise_for_status(self, sleep):
+        self.ts.client.raise_for_status(response(200))
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.ts.client.raise_for_status(response(404))
+
+    def test_no_retry_post(self, sleep):
+        with mock.patch('tesselate.client.requests.Session.post', side_effect=[response(503), response(200)]) as post:
+            with self.assertRaises(requests.exceptions.HTTPError):
+                self.ts.formula(data={'name': 'NDVI'})
+        self.assertEqual(post.call_count, 1)
+        # Posts that were rejected by the rate limit are safe to repeat.
+        with mock.patch('tesselate.client.requests.Session.post', side_effect=[response(429), response(200)]) as post:
+            self.ts.formula(data={'name': 'NDVI'})
+        self.assertEqual(post.call_count, 2)
+
+    def test_client_errors_not_retried(self, sleep):
+        with mock.patch('tesselate.client.requests.Session.get', return_value=response(404)) as get:
+            with self.assertRaises(requests.exceptions.HTTPError):
+                self.ts.formula(id=1)
+        self.assertEqual(get.call_count, 1)
+
+
+class TestTesselateClientRateLimit(unittest.TestCase):
+
+    @mock.patch('tesselate.client.time.sleep')
+    def test_token_bucket(self, sleep):
+        bucket = TokenBucket(10, burst=2)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertAlmostEqual(bucket.acquire(), 0.1, places=2)
+        # Waiting requests queue up.
+        self.assertAlmostEqual(bucket.acquire(), 0.2, places=2)
+
+    @mock.patch('tesselate.client.time.sleep')
+    @mock.patch('tesselate.client.time.monotonic', return_value=0)
+    def test_rate_limit_shared(self, monotonic, sleep):
+        os.environ['TESSELO_ACCESS_TOKEN'] = 'tesselate test token env'
+        ts = Tesselate()
+        ts.client.set_rate_limit(1000, burst=1)
+        with mock.patch('tesselate.client.requests.Session.get', return_value=response(200)):
+            threads = [threading.Thread(target=ts.formula) for i in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(ts.client.metrics['requests'], 5)
+        self.assertEqual(ts.client.metrics['throttled'], 4)
@@ -0,0 +1,379 @@
+import os
+import re
+import tempfile
+import unittest
+import uuid
+from ctypes import c_char_p, c_int, c_void_p
+
+import mock
+import numpy
+import requests
+from django.contrib.gis.gdal import GDALRaster, OGRGeometry
+from django.contrib.gis.gdal.driver import Driver
+from django.contrib.gis.gdal.prototypes.raster import copy_ds
+from raster.rasterize import rasterize
+from raster.tiles.utils import tile_bounds
+
+from tesselate import Tesselate
+from tesselate.export import _create_target_raster, _write_cog, read_manifest
+from tesselate.pipeline import Pipeline
+from tests.utils import TesselateMockResponseBase
+
+
+def tile_bytes(tilez, tilex, tiley):
+    # Tile values depend on the tile index to detect misplaced tiles.
+    data = numpy.arange(256 * 256, dtype='float32').reshape(256, 256) + tilex * 1e5 + tiley * 1e3
+    rst = GDALRaster({
+        'name': '/vsimem/tile-{}-{}-{}-{}.tif'.format(tilez, tilex, tiley, uuid.uuid4()),
+        'driver': 'tif',
+        'width': 256,
+        'height': 256,
+        'srid': 3857,
+        'datatype': 6,
+        'bands': [{'data': data, 'nodata_value': 0}],
+    })
+    return bytes(rst.vsi_buffer)
+
+
+def png_bytes(tilex, tiley):
+    # Rgba png with band values depending on the tile index.
+    rst = GDALRaster({
+        'name': 'png',
+        'driver': 'MEM',
+        'width': 256,
+        'height': 256,
+        'srid': 3857,
+        'datatype': 1,
+        'bands': [{'data': numpy.full((256, 256), value, dtype='uint8')} for value in (tilex % 256, tiley % 256, 7, 255)],
+    })
+    png = GDALRaster(copy_ds(Driver('PNG')._ptr, b'/vsimem/tile.png', rst._ptr, c_int(), c_char_p(), c_void_p(), c_void_p()))
+    return bytes(png.vsi_buffer)
+
+
+def mock_get_png(session, url):
+
+    class MockResponse(TesselateMockResponseBase):
+
+        @property
+        def content(self):
+            tilez, tilex, tiley = re.search(r'algebra/(\d+)/(\d+)/(\d+)\.png', url).groups()
+            # Return an unreadable tile for the last tile.
+            if tilex == '486' and tiley == '392':
+                return b'Not a png'
+            return png_bytes(int(tilex), int(tiley))
+
+    return MockResponse()
+
+
+def mock_get_algebra(session, url):
+
+    class MockResponse(TesselateMockResponseBase):
+
+        @property
+        def content(self):
+            tilez, tilex, tiley = re.search(r'algebra/(\d+)/(\d+)/(\d+)\.tif', url).groups()
+            return tile_bytes(int(tilez), int(tilex), int(tiley))
+
+    return MockResponse()
+
+
+@mock.patch('tesselate.client.requests.Session.get', mock_get_algebra)
+class TestTesselateExport(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['TESSELO_ACCESS_TOKEN'] = 'tesselate test token env'
+        self.ts = Tesselate()
+        self.region = {'id': 1, 'name': 'Lisbon', 'extent': [-9.3, 38.6, -9.0, 38.95]}
+        self.composite = {'id': 1, 'name': 'March', 'rasterlayer_lookup': {'B04.jp2': 1, 'B08.jp2': 2}}
+        self.formula = {'id': 1, 'name': 'NDVI', 'acronym': 'NDVI', 'formula': '(B8 - B4) / (B8 + B4)'}
+
+    def test_export_array(self):
+        result = self.ts.export(self.region, self.composite, self.formula, None, zoom=10)
+        # The region covers a 2 by 2 tile block at zoom 10.
+        self.assertEqual(result.shape, (1, 512, 512))
+        self.assertEqual(result[0, 0, 1], 1 + 485 * 1e5 + 391 * 1e3)
+        self.assertEqual(result[0, 256, 256], 486 * 1e5 + 392 * 1e3)
+
+    def test_export_concurrent_array(self):
+        serial = self.ts.export(self.region, self.composite, self.formula, None, zoom=10)
+        concurrent = self.ts.export(self.region, self.composite, self.formula, None, zoom=10, workers=4)
+        numpy.testing.assert_array_equal(serial, concurrent)
+
+    def test_export_concurrent_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            serial_path = os.path.join(tmpdir, 'serial.tif')
+            concurrent_path = os.path.join(tmpdir, 'concurrent.tif')
+            self.ts.export(self.region, self.composite, self.formula, serial_path, zoom=10)
+            self.ts.export(self.region, self.composite, self.formula, concurrent_path, zoom=10, workers=3)
+            with open(serial_path, 'rb') as serial, open(concurrent_path, 'rb') as concurrent:
+                self.assertEqual(serial.read(), concurrent.read())
+
+    def test_export_pipeline(self):
+        serial = self.ts.export(self.region, self.composite, self.formula, None, zoom=10)
+        pipeline = Pipeline(fetch_workers=2, decode_workers=2, queue_size=2)
+        piped = self.ts.export(self.region, self.composite, self.formula, None, zoom=10, pipeline=pipeline)
+        numpy.testing.assert_array_equal(serial, piped)
+        stats = pipeline.stats()
+        self.assertEqual(list(stats.keys()), ['fetch', 'decode', 'write'])
+        for stage in stats.values():
+            self.assertEqual(stage['count'], 4)
+            self.assertEqual(stage['queue_depth'], 0)
+            self.assertGreater(stage['items_per_second'], 0)
+
+    def test_export_pipeline_error(self):
+        with mock.patch('tesselate.client.requests.Session.get', side_effect=ValueError('Tile not available')):
+            with self.assertRaises(ValueError):
+                self.ts.export(self.region, self.composite, self.formula, None, zoom=10, pipeline=Pipeline(queue_size=1))
+
+    def test_export_sparse(self):
+        # Region geometry within the top left tile of the block.
+        xmin, ymin, xmax, ymax = tile_bounds(485, 391, 10)
+        self.region['geom'] = 'SRID=3857;POLYGON(({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))'.format(
+            xmin + 1000, ymin + 1000, xmax - 1000, ymax - 1000,
+        )
+        with mock.patch('tesselate.client.requests.Session.get', autospec=True, side_effect=mock_get_algebra) as get:
+            result = self.ts.export(self.region, self.composite, self.formula, None, zoom=10, sparse=True)
+        # Only the intersecting tile was fetched.
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(result.shape, (1, 512, 512))
+        self.assertEqual(result[0, 0, 1], 1 + 485 * 1e5 + 391 * 1e3)
+        self.assertFalse(numpy.any(result[0, 256:, :]))
+        self.assertFalse(numpy.any(result[0, :, 256:]))
+
+    def test_export_sparse_tile_aligned(self):
+        # Region geometry equal to the top left tile.
+        self.region['geom'] = 'SRID=3857;POLYGON(({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))'.format(*tile_bounds(485, 391, 10))
+        with mock.patch('tesselate.client.requests.Session.get', autospec=True, side_effect=mock_get_algebra) as get:
+            result = self.ts.export(self.region, self.composite, self.formula, None, zoom=10, sparse=True)
+        # Tiles that only touch the region are not fetched.
+        self.assertEqual(get.call_count, 1)
+        self.assertFalse(numpy.any(result[0, 256:, :]))
+        self.assertFalse(numpy.any(result[0, :, 256:]))
+
+    def test_export_sparse_file(self):
+        self.region['geom'] = 'SRID=4326;POLYGON((-9.3 38.6, -9.0 38.6, -9.0 38.95, -9.3 38.95, -9.3 38.6))'
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'sparse.tif')
+            self.ts.export(self.region, self.composite, self.formula, path, zoom=10, sparse=True)
+            rst = GDALRaster(path)
+            self.assertEqual(rst.bands[0].data()[256, 256], 486 * 1e5 + 392 * 1e3)
+
+    def test_export_cog(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'cog.tif')
+            self.ts.export(self.region, self.composite, self.formula, path, zoom=10, cog=True, predictor=3)
+            # The temporary file was removed.
+            self.assertEqual(os.listdir(tmpdir), ['cog.tif'])
+            rst = GDALRaster(path)
+            self.assertEqual(rst.metadata['IMAGE_STRUCTURE']['LAYOUT'], 'COG')
+            self.assertEqual(rst.metadata['IMAGE_STRUCTURE']['COMPRESSION'], 'DEFLATE')
+            self.assertEqual(rst.metadata['IMAGE_STRUCTURE']['PREDICTOR'], '3')
+            self.assertEqual(rst.bands[0].data()[256, 256], 486 * 1e5 + 392 * 1e3)
+            # The 512 pixel raster has one overview level.
+            self.assertIn('Overviews: 256x256', rst.info)
+
+    def test_write_cog_closes_target(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            target = _create_target_raster((485, 391, 486, 392), os.path.join(tmpdir, 'cog.tif.tmp'), 10)
+            _write_cog(target, os.path.join(tmpdir, 'cog.tif'))
+            # The temporary dataset is closed before its file is removed.
+            self.assertIsNone(target._ptr)
+            self.assertEqual(os.listdir(tmpdir), ['cog.tif'])
+
+    def test_export_cog_requires_path(self):
+        with self.assertRaises(ValueError):
+            self.ts.export(self.region, self.composite, self.formula, None, zoom=10, cog=True)
+
+    def test_export_chunks(self):
+        serial = self.ts.export(self.region, self.composite, self.formula, None, zoom=10)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'mosaic.vrt')
+            self.ts.export(self.region, self.composite, self.formula, path, zoom=10, chunk_size=1)
+            self.assertEqual(len(os.listdir(tmpdir)), 5)
+            numpy.testing.assert_array_equal(GDALRaster(path).bands[0].data(), serial[0])
+            # Rerunning only exports missing blocks.
+            os.remove(os.path.join(tmpdir, 'mosaic_486_392.tif'))
+            with mock.patch('tesselate.client.requests.Session.get', autospec=True, side_effect=mock_get_algebra) as get:
+                self.ts.export(self.region, self.composite, self.formula, path, zoom=10, chunk_size=1)
+            self.assertEqual(get.call_count, 1)
+            numpy.testing.assert_array_equal(GDALRaster(path).bands[0].data(), serial[0])
+
+    def test_export_chunks_cog(self):
+        serial = self.ts.export(self.region, self.composite, self.formula, None, zoom=10)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'mosaic.vrt')
+            self.ts.export(self.region, self.composite, self.formula, path, zoom=10, chunk_size=1, cog=True)
+            # No temporary files are left next to the blocks.
+            self.assertFalse([name for name in os.listdir(tmpdir) if name.endswith('.tmp')])
+            self.assertEqual(len(os.listdir(tmpdir)), 5)
+            numpy.testing.assert_array_equal(GDALRaster(path).bands[0].data(), serial[0])
+
+    def test_export_chunks_requires_path(self):
+        with self.assertRaises(ValueError):
+            self.ts.export(self.region, self.composite, self.formula, None, zoom=10, chunk_size=1)
+
+    def test_export_resume(self):
+        serial = self.ts.export(self.region, self.composite, self.formula, None, zoom=10)
+
+        def flaky_get(session, url):
+            if '/486/392.tif' in url:
+                raise requests.exceptions.ConnectionError('Connection reset')
+            return mock_get_algebra(session, url)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'resume.tif')
+            with mock.patch('tesselate.client.requests.Session.get', autospec=True, side_effect=flaky_get):
+                self.ts.export(self.region, self.composite, self.formula, path, zoom=10, resume=True)
+            # The failed tile is recorded in the manifest.
+            completed, failed = read_manifest(path + '.manifest')
+            self.assertEqual(len(completed), 3)
+            self.assertEqual(failed, {(486, 392)})
+            # Resuming only fetches the failed tile.
+            with mock.patch('tesselate.client.requests.Session.get', autospec=True, side_effect=mock_get_algebra) as get:
+                self.ts.export(self.region, self.composite, self.formula, path, zoom=10, resume=True)
+            self.assertEqual(get.call_count, 1)
+            self.assertFalse(os.path.exists(path + '.manifest'))
+            numpy.testing.assert_array_equal(GDALRaster(path).bands[0].data(), serial[0])
+
+    def test_export_resume_corrupt_tile(self):
+        def corrupt_get(session, url):
+            if '/486/392.tif' in url:
+
+                class MockResponse(TesselateMockResponseBase):
+                    content = b'not a tile'
+
+                return MockResponse()
+            return mock_get_algebra(session, url)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'resume.tif')
+            with mock.patch('tesselate.client.requests.Session.get', autospec=True, side_effect=corrupt_get):
+                failed = self.ts.export(self.region, self.composite, self.formula, path, zoom=10, resume=True)
+            # Undecodable tiles are recorded as failed.
+            self.assertEqual(failed, [(486, 392)])
+            completed, failed = read_manifest(path + '.manifest')
+            self.assertEqual(len(completed), 3)
+            self.assertEqual(failed, {(486, 392)})
+
+    def test_export_resume_other_export(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'resume.tif')
+            with mock.patch('tesselate.client.requests.Session.get', side_effect=requests.exceptions.ConnectionError()):
+                self.ts.export(self.region, self.composite, self.formula, path, zoom=10, resume=True)
+            with self.assertRaises(ValueError):
+                self.ts.export(self.region, self.composite, self.formula, path, zoom=11, resume=True)
+
+    def test_iter_tiles(self):
+        serial = self.ts.export(self.region, self.composite, self.formula, None, zoom=10)
+        result = list(self.ts.iter_tiles(self.region, self.composite, self.formula, zoom=10))
+        self.assertEqual([(tilex, tiley) for tilex, tiley, bounds, data in result], [(485, 391), (485, 392), (486, 391), (486, 392)])
+        tilex, tiley, bounds, data = result[3]
+        self.assertEqual(bounds, tile_bounds(486, 392, 10))
+        numpy.testing.assert_array_equal(data, serial[:, 256:, 256:])
+
+    def test_iter_tiles_unordered(self):
+        result = self.ts.iter_tiles(self.region, self.composite, self.formula, zoom=10, workers=4, ordered=False)
+        self.assertEqual(sorted((tilex, tiley) for tilex, tiley, bounds, data in result), [(485, 391), (485, 392), (486, 391), (486, 392)])
+
+    def test_export_memmap(self):
+        serial = self.ts.export(self.region, self.composite, self.formula, None, zoom=10)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            result, geotransform = self.ts.export(self.region, self.composite, self.formula, None, zoom=10, out=os.path.join(tmpdir, 'result.dat'))
+            self.assertIsInstance(result, numpy.memmap)
+            numpy.testing.assert_array_equal(result, serial)
+            self.assertEqual(geotransform[0], tile_bounds(485, 391, 10)[0])
+            self.assertEqual(geotransform[3], tile_bounds(485, 391, 10)[3])
+
+    def test_export_array_clip(self):
+        xmin, ymin, xmax, ymax = tile_bounds(485, 391, 10)
+        self.region['geom'] = 'SRID=3857;POLYGON(({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))'.format(xmin, ymin - 5000, xmax + 5000, ymax)
+        serial = self.ts.export(self.region, self.composite, self.formula, None, zoom=10, clip_to_geom=True)
+        out = numpy.zeros((1, 512, 512), dtype='float32')
+        result, geotransform = self.ts.export(self.region, self.composite, self.formula, None, zoom=10, out=out, clip_to_geom=True)
+        self.assertIs(result, out)
+        numpy.testing.assert_array_equal(out, serial)
+        self.assertFalse(numpy.any(out[0, 300:, 300:]))
+        self.assertTrue(numpy.all(out[0, :256, :256]))
+
+    def test_export_array_shape_mismatch(self):
+        with self.assertRaises(ValueError):
+            self.ts.export(self.region, self.composite, self.formula, None, zoom=10, out=numpy.zeros((1, 256, 256)))
+
+    def test_export_rgb(self):
+        self.composite['rasterlayer_lookup'].update({'B02.jp2': 3, 'B03.jp2': 4})
+        formula = {'id': 2, 'name': 'RGB', 'acronym': 'RGB', 'formula': ''}
+        with mock.patch('tesselate.client.requests.Session.get', mock_get_png):
+            result = self.ts.export(self.region, self.composite, formula, None, zoom=10)
+        self.assertEqual(result.shape, (3, 512, 512))
+        self.assertEqual(result.dtype, numpy.uint8)
+        self.assertEqual(list(result[:, 0, 0]), [485 % 256, 391 % 256, 7])
+        self.assertEqual(list(result[:, 300, 0]), [485 % 256, 392 % 256, 7])
+        # The unreadable tile is left empty.
+        self.assertFalse(numpy.any(result[:, 256:, 256:]))
+
+    def test_export_formula_stack(self):
+        water = {'id': 2, 'name': 'Water', 'acronym': 'W', 'formula': 'B4'}
+
+        def get_stack(session, url):
+            # Shift the tile index for the second formula to distinguish bands.
+            if 'formula=B4&' in url:
+                url = re.sub(r'algebra/(\d+)/(\d+)/', lambda match: 'algebra/{}/{}/'.format(match.group(1), int(match.group(2)) + 1), url)
+            return mock_get_algebra(session, url)
+
+        with mock.patch('tesselate.client.requests.Session.get', autospec=True, side_effect=get_stack) as get:
+            result = self.ts.export(self.region, self.composite, [self.formula, water], None, zoom=10, workers=3)
+        self.assertEqual(get.call_count, 8)
+        self.assertEqual(result.shape, (2, 512, 512))
+        self.assertEqual(result[0, 0, 1], numpy.float32(1 + 485 * 1e5 + 391 * 1e3))
+        self.assertEqual(result[1, 0, 1], numpy.float32(1 + 486 * 1e5 + 391 * 1e3))
+        self.assertEqual(result[1, 256, 256], numpy.float32(487 * 1e5 + 392 * 1e3))
+
+    def test_export_formula_stack_pipeline(self):
+        water = {'id': 2, 'name': 'Water', 'acronym': 'W', 'formula': 'B4'}
+        serial = self.ts.export(self.region, self.composite, [self.formula, water], None, zoom=10)
+        piped = self.ts.export(self.region, self.composite, [self.formula, water], None, zoom=10, pipeline=Pipeline(fetch_workers=2))
+        numpy.testing.assert_array_equal(serial, piped)
+
+    def test_export_formula_stack_rgb(self):
+        rgb = {'id': 2, 'name': 'RGB', 'acronym': 'RGB', 'formula': ''}
+        with self.assertRaises(ValueError):
+            self.ts.export(self.region, self.composite, [self.formula, rgb], None, zoom=10)
+
+    def test_export_clip_per_tile(self):
+        # Two overlapping areas covering the top left tile and part of the
+        # bottom left tile, the right tiles are outside.
+        xmin, ymin, xmax, ymax = tile_bounds(485, 391, 10)
+        polygon = 'SRID=3857;POLYGON(({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))'
+        self.region['aggregationareas'] = [
+            {'id': 1, 'geom': polygon.format(xmin - 1000, ymin + 1000, xmax - 5000, ymax + 1000)},
+            {'id': 2, 'geom': polygon.format(xmin + 2000, ymin - 9000, xmax - 8000, ymin + 9000)},
+        ]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'full.tif')
+            self.ts.export(self.region, self.composite, self.formula, path, zoom=10)
+            full = GDALRaster(path)
+            union = OGRGeometry(self.region['aggregationareas'][0]['geom']).union(OGRGeometry(self.region['aggregationareas'][1]['geom']))
+            expected = full.bands[0].data() * (rasterize(union, full, all_touched=True).bands[0].data() == 1)
+            with mock.patch('tesselate.client.requests.Session.get', autospec=True, side_effect=mock_get_algebra) as get:
+                result = self.ts.export(self.region, self.composite, self.formula, None, zoom=10, clip_to_geom=True, all_touched=True)
+        # The tiles on the right are outside of the areas.
+        self.assertEqual(get.call_count, 2)
+        numpy.testing.assert_array_equal(result[0], expected)
+        self.assertTrue(numpy.any(result[0, 256:, :256]))
+
+    def test_export_clip_tile_aligned(self):
+        # Region covering the top left tile and the upper half of the bottom
+        # left tile, the right tiles only touch the region.
+        xmin, ymin, xmax, ymax = tile_bounds(485, 391, 10)
+        self.region['geom'] = 'SRID=3857;POLYGON(({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))'.format(
+            xmin, ymin - (ymax - ymin) / 2, xmax, ymax,
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'full.tif')
+            self.ts.export(self.region, self.composite, self.formula, path, zoom=10)
+            full = GDALRaster(path)
+            expected = full.bands[0].data() * (rasterize(OGRGeometry(self.region['geom']), full).bands[0].data() == 1)
+            with mock.patch('tesselate.client.requests.Session.get', autospec=True, side_effect=mock_get_algebra) as get:
+                result = self.ts.export(self.region, self.composite, self.formula, None, zoom=10, clip_to_geom=True)
+        self.assertEqual(get.call_count, 2)
+        numpy.testing.assert_array_equal(result[0], expected)
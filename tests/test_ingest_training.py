@@ -1,7 +1,10 @@
 import os
+import tempfile
 import unittest
 
 import mock
+import requests
+from django.contrib.gis.gdal import DataSource
 
 from tesselate import Tesselate
 from tests.utils import TesselateMockResponseBase
@@ -115,3 +118,129 @@ class TestTesselateTriggers(unittest.TestCase):
 
         with self.assertRaises(ValueError):
             self.ts.ingest(traininglayer, scene, shapefile, class_column, valuemap, date_column, reset=False)
+
+
+@mock.patch('builtins.input', lambda: 'yes')
+@mock.patch('sys.stdout.write', lambda x: None)
+class TestTesselateIngestConcurrent(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['TESSELO_ACCESS_TOKEN'] = 'tesselate test token env'
+        self.ts = Tesselate()
+        self.shapefile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data/training.shp')
+        self.geoms = [feat.geom.ewkt for feat in DataSource(self.shapefile)[0]]
+        self.valuemap = {'burn': 1, 'soil': 2, 'other': 3, 'bamboo': 4}
+        self.failures = set()
+
+    def mock_post(self, session, url, json):
+        if json['geom'] in self.failures:
+            self.failures.remove(json['geom'])
+            raise requests.exceptions.ConnectionError('Connection reset.')
+
+        class MockResponse(TesselateMockResponseBase):
+
+            def json(self):
+                # Use the geometry as id to check the sample order.
+                return {'id': json['geom']}
+
+        return MockResponse()
+
+    def test_ingestion_concurrent_order(self):
+        traininglayer = {'id': 1, 'name': 'Test training layer', 'trainingsamples': [], 'continuous': False}
+        with mock.patch('tesselate.client.requests.Session.post', autospec=True, side_effect=self.mock_post):
+            response = self.ts.ingest(traininglayer, {'id': 2}, self.shapefile, 'class', self.valuemap, workers=4, chunk_size=3)
+        self.assertEqual(response['trainingsamples'], self.geoms)
+
+    def test_ingestion_retry(self):
+        traininglayer = {'id': 1, 'name': 'Test training layer', 'trainingsamples': [], 'continuous': False}
+        self.failures = {self.geoms[4], self.geoms[11]}
+        created = {}
+        reports = []
+        with mock.patch('tesselate.client.requests.Session.post', autospec=True, side_effect=self.mock_post):
+            response = self.ts.ingest(traininglayer, {'id': 2}, self.shapefile, 'class', self.valuemap, workers=4, chunk_size=5, created=created, reports=reports)
+        self.assertEqual(len(response['trainingsamples']), 18)
+        # One report per chunk with the failed feature indices.
+        self.assertEqual([report['created'] for report in reports], [4, 5, 4, 5])
+        self.assertEqual([report['failed'] for report in reports], [[4], [], [11], []])
+        self.assertNotIn(4, created)
+        self.assertNotIn(11, created)
+
+        # Retrying only posts the failed samples.
+        with mock.patch('tesselate.client.requests.Session.post', autospec=True, side_effect=self.mock_post) as post:
+            response = self.ts.ingest(traininglayer, {'id': 2}, self.shapefile, 'class', self.valuemap, created=created)
+        self.assertEqual(post.call_count, 2)
+        self.assertEqual(len(response['trainingsamples']), 20)
+        self.assertEqual([created[index] for index in range(20)], self.geoms)
+
+    def test_ingestion_checkpoint(self):
+        traininglayer = {'id': 1, 'name': 'Test training layer', 'trainingsamples': [], 'continuous': False}
+        self.failures = {self.geoms[7]}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            checkpoint = os.path.join(tmpdir, 'checkpoint.json')
+            with mock.patch('tesselate.client.requests.Session.post', autospec=True, side_effect=self.mock_post):
+                self.ts.ingest(traininglayer, {'id': 2}, self.shapefile, 'class', self.valuemap, chunk_size=4, checkpoint=checkpoint)
+
+            # The rerun uses a fresh process state and resumes from the checkpoint.
+            traininglayer = {'id': 1, 'name': 'Test training layer', 'trainingsamples': [], 'continuous': False}
+            with mock.patch('tesselate.client.requests.Session.post', autospec=True, side_effect=self.mock_post) as post:
+                response = self.ts.ingest(traininglayer, {'id': 2}, self.shapefile, 'class', self.valuemap, chunk_size=4, checkpoint=checkpoint)
+            self.assertEqual(post.call_count, 1)
+            self.assertEqual(response['trainingsamples'], [self.geoms[7]])
+
+            with open(checkpoint) as fl:
+                self.assertEqual(len(fl.readlines()), 21)
+
+            # Checkpoints are bound to their traininglayer.
+            with self.assertRaises(ValueError):
+                self.ts.ingest({'id': 2, 'trainingsamples': []}, {'id': 2}, self.shapefile, 'class', self.valuemap, checkpoint=checkpoint)
+
+    def test_ingestion_sync(self):
+        features = list(DataSource(self.shapefile)[0])
+        # Samples as they are stored on the api, in a different projection.
+        remote = []
+        for index, feat in enumerate(features[:12]):
+            geom = feat.geom.clone()
+            geom.transform(4326)
+            remote.append({
+                'id': 100 + index,
+                'traininglayer': 1,
+                'category': feat['class'].as_string(),
+                'value': float(self.valuemap[feat['class'].as_string()]),
+                'geom': geom.ewkt,
+                'date': '',
+                'attributes': {'date': str(feat.get('date')), 'date_strin': str(feat.get('date_strin'))},
+            })
+        # Change the class of one sample and add one that is not in the file.
+        remote[3]['category'] = 'other' if remote[3]['category'] != 'other' else 'burn'
+        remote.append(dict(remote[0], id=200, geom='SRID=4326;POLYGON((0 0, 1 0, 1 1, 0 0))'))
+        traininglayer = {'id': 1, 'name': 'Test training layer', 'trainingsamples': [sample['id'] for sample in remote], 'continuous': False}
+
+        class MockListResponse(TesselateMockResponseBase):
+
+            def json(self):
+                return {'count': len(remote), 'next': None, 'previous': None, 'results': remote}
+
+        with mock.patch('tesselate.client.requests.Session.get', return_value=MockListResponse()) as get, \
+                mock.patch('tesselate.client.requests.Session.post', autospec=True, side_effect=self.mock_post) as post, \
+                mock.patch('tesselate.client.requests.Session.patch', return_value=TesselateMockResponseBase()) as patch, \
+                mock.patch('tesselate.client.requests.Session.delete', return_value=TesselateMockResponseBase()) as delete:
+            reports = []
+            response = self.ts.ingest(traininglayer, {'id': 2}, self.shapefile, 'class', self.valuemap, sync=True, workers=2, reports=reports)
+
+        self.assertEqual(get.call_args[0][0], 'https://api.tesselo.com/trainingsample?traininglayer=1')
+        self.assertEqual(post.call_count, 8)
+        self.assertEqual(patch.call_count, 1)
+        self.assertEqual(patch.call_args[0][0], 'https://api.tesselo.com/trainingsample/103')
+        self.assertEqual(delete.call_count, 1)
+        self.assertEqual(delete.call_args[0][0], 'https://api.tesselo.com/trainingsample/200')
+        self.assertEqual(response['trainingsamples'], [100 + index for index in range(12)] + self.geoms[12:])
+        self.assertEqual(sum(report['created'] for report in reports), 8)
+
+    def test_ingestion_sync_reset(self):
+        traininglayer = {'id': 1, 'name': 'Test training layer', 'trainingsamples': [], 'continuous': False}
+        with self.assertRaises(ValueError):
+            self.ts.ingest(traininglayer, {'id': 2}, self.shapefile, 'class', self.valuemap, reset=True, sync=True)
+        with self.assertRaises(ValueError):
+            self.ts.ingest(traininglayer, {'id': 2}, self.shapefile, 'class', self.valuemap, sync=True, checkpoint='checkpoint.json')
+        with self.assertRaises(ValueError):
+            self.ts.ingest(traininglayer, {'id': 2}, self.shapefile, 'class', self.valuemap, sync=True, created={})
@@ -0,0 +1,43 @@
+import os
+import unittest
+
+import mock
+import numpy
+
+from tesselate import Tesselate
+from tests.test_export import mock_get_algebra
+from tests.utils import tile_coords, tile_value
+
+
+class TestTesselatePixels(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['TESSELO_ACCESS_TOKEN'] = 'tesselate test token env'
+        self.ts = Tesselate()
+        self.predictedlayer = {'id': 1, 'rasterlayer': 23}
+        self.composite = {'id': 1, 'name': 'March', 'rasterlayer_lookup': {'B04.jp2': 1, 'B08.jp2': 2}}
+        self.formula = {'id': 1, 'name': 'NDVI', 'acronym': 'NDVI', 'formula': '(B8 - B4) / (B8 + B4)'}
+
+    def test_pixels_from_coords(self):
+        pixels = [(485, 391, 3, 5), (486, 392, 200, 7), (485, 391, 255, 0), (486, 392, 0, 255)]
+        with mock.patch('tesselate.client.requests.Session.get', autospec=True, side_effect=mock_get_algebra) as get:
+            result = self.ts.pixels_from_coords(self.predictedlayer, [tile_coords(*pixel) for pixel in pixels], zoom=10)
+        # Every tile is requested once.
+        self.assertEqual(get.call_count, 2)
+        self.assertIn('formula=x&layers=x=23', get.call_args[0][1])
+        self.assertEqual(list(result), [tile_value(*pixel) for pixel in pixels])
+
+    def test_pixels_from_coords_formula(self):
+        pixels = [(486, 391, 10, 20), (485, 392, 30, 40), (486, 391, 11, 21)]
+        with mock.patch('tesselate.client.requests.Session.get', autospec=True, side_effect=mock_get_algebra) as get:
+            result = self.ts.pixels_from_coords(self.composite, [tile_coords(*pixel) for pixel in pixels], zoom=10, formula=self.formula, workers=2)
+        self.assertEqual(get.call_count, 2)
+        self.assertIn('layers=B4=1,B8=2', get.call_args[0][1])
+        self.assertEqual(list(result), [tile_value(*pixel) for pixel in pixels])
+
+    def test_pixels_from_coords_nodata(self):
+        # The first pixel of tile 0/0 has the nodata value.
+        pixels = [(0, 0, 0, 0), (0, 0, 0, 1)]
+        with mock.patch('tesselate.client.requests.Session.get', autospec=True, side_effect=mock_get_algebra):
+            result = self.ts.pixels_from_coords(self.predictedlayer, [tile_coords(*pixel) for pixel in pixels], zoom=10)
+        numpy.testing.assert_array_equal(result, [numpy.nan, 1])
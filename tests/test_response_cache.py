@@ -0,0 +1,73 @@
+import os
+import unittest
+
+import mock
+
+from tesselate import Tesselate
+from tests.utils import response
+
+
+class TestTesselateResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['TESSELO_ACCESS_TOKEN'] = 'tesselate test token env'
+        self.ts = Tesselate()
+        self.ts.client.set_response_cache({'formula': 60})
+
+    def test_cache_hit(self):
+        with mock.patch('tesselate.client.requests.Session.get', return_value=response(200, b'{"id": 1, "name": "NDVI"}')) as get:
+            formula = self.ts.formula(id=1)
+            # Modifying the result does not change the cache.
+            formula['name'] = 'Banana'
+            self.assertEqual(self.ts.formula(id=1)['name'], 'NDVI')
+            self.ts.formula(id=2)
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(self.ts.client.response_cache.stats['hits'], 1)
+        self.assertEqual(self.ts.client.response_cache.stats['misses'], 2)
+
+    def test_endpoint_without_ttl(self):
+        with mock.patch('tesselate.client.requests.Session.get', return_value=response(200)) as get:
+            self.ts.composite(id=1)
+            self.ts.composite(id=1)
+        self.assertEqual(get.call_count, 2)
+
+    def test_revalidation(self):
+        headers = {'ETag': '"abc"', 'Last-Modified': 'Wed, 21 Oct 2015 07:28:00 GMT'}
+        with mock.patch('tesselate.client.requests.Session.get', side_effect=[response(200, b'{"id": 1}', headers), response(304)]) as get:
+            self.ts.formula(id=1)
+            # Expire the entry.
+            self.ts.client.response_cache.get('https://api.tesselo.com/formula/1')['expires'] = 0
+            self.assertEqual(self.ts.formula(id=1), {'id': 1})
+        self.assertEqual(get.call_args[1]['headers'], {'If-None-Match': '"abc"', 'If-Modified-Since': 'Wed, 21 Oct 2015 07:28:00 GMT'})
+        self.assertEqual(self.ts.client.response_cache.stats['revalidations'], 1)
+        # The entry is fresh again.
+        self.assertGreater(self.ts.client.response_cache.get('https://api.tesselo.com/formula/1')['expires'], 0)
+
+    def test_invalidation(self):
+        with mock.patch('tesselate.client.requests.Session.get', return_value=response(200, b'{"id": 1}')) as get:
+            self.ts.formula(id=1)
+            self.ts.formula()
+            with mock.patch('tesselate.client.requests.Session.patch', return_value=response(200, b'{"id": 1}')):
+                self.ts.formula(data={'id': 1, 'name': 'NDVI'})
+            self.ts.formula(id=1)
+        self.assertEqual(get.call_count, 3)
+        self.assertEqual(self.ts.client.response_cache.stats['invalidations'], 2)
+
+    def test_max_entries(self):
+        self.ts.client.set_response_cache({'formula': 60}, max_entries=2)
+        with mock.patch('tesselate.client.requests.Session.get', return_value=response(200)) as get:
+            self.ts.formula(id=1)
+            self.ts.formula(id=2)
+            self.ts.formula(id=1)
+            self.ts.formula(id=3)
+            # The least recently used entry was removed.
+            self.ts.formula(id=1)
+            self.ts.formula(id=2)
+        self.assertEqual(get.call_count, 4)
+
+    def test_disable(self):
+        self.ts.client.set_response_cache(None)
+        with mock.patch('tesselate.client.requests.Session.get', return_value=response(200)) as get:
+            self.ts.formula(id=1)
+            self.ts.formula(id=1)
+        self.assertEqual(get.call_count, 2)
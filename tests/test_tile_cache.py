@@ -0,0 +1,84 @@
+import os
+import tempfile
+import unittest
+
+import mock
+
+from tesselate import Tesselate, tiles
+from tesselate.cache import TileCache
+from tests.utils import TesselateMockResponseBase
+
+
+class MockTileResponse(TesselateMockResponseBase):
+
+    @property
+    def content(self):
+        return b'tile data'
+
+
+class TestTesselateTileCache(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['TESSELO_ACCESS_TOKEN'] = 'tesselate test token env'
+        self.ts = Tesselate()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.composite = {'id': 1, 'rasterlayer_lookup': {'B02.jp2': 1, 'B03.jp2': 2, 'B04.jp2': 3, 'B08.jp2': 4}}
+        self.formula = {'id': 1, 'formula': '(B8 - B4) / (B8 + B4)'}
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    @mock.patch('tesselate.client.requests.Session.get', return_value=MockTileResponse())
+    def test_algebra_cache(self, get):
+        self.ts.client.set_tile_cache(self.tmpdir.name)
+        self.assertEqual(tiles.algebra(self.ts.client, 14, 1, 2, self.composite, self.formula), b'tile data')
+        self.assertEqual(tiles.algebra(self.ts.client, 14, 1, 2, self.composite, self.formula), b'tile data')
+        self.assertEqual(get.call_count, 1)
+        # A different tile is not in the cache.
+        tiles.algebra(self.ts.client, 14, 1, 3, self.composite, self.formula)
+        self.assertEqual(get.call_count, 2)
+        self.assertEqual(self.ts.client.tile_cache.stats['hits'], 1)
+        self.assertEqual(self.ts.client.tile_cache.stats['misses'], 2)
+        self.assertEqual(self.ts.client.tile_cache.stats['bytes_read'], 9)
+        self.assertEqual(self.ts.client.tile_cache.stats['bytes_written'], 18)
+
+    @mock.patch('tesselate.client.requests.Session.get', return_value=MockTileResponse())
+    def test_rgb_cache_shared(self, get):
+        self.ts.client.set_tile_cache(self.tmpdir.name)
+        tiles.rgb(self.ts.client, 14, 1, 2, self.composite)
+        # A second client with the same directory uses the cached tile.
+        other = Tesselate()
+        other.client.set_tile_cache(self.tmpdir.name)
+        tiles.rgb(other.client, 14, 1, 2, self.composite)
+        self.assertEqual(get.call_count, 1)
+        self.assertEqual(other.client.tile_cache.stats['hits'], 1)
+
+    @mock.patch('tesselate.client.requests.Session.get', return_value=MockTileResponse())
+    def test_cache_disabled(self, get):
+        self.ts.client.set_tile_cache(self.tmpdir.name)
+        self.ts.client.set_tile_cache(None)
+        tiles.algebra(self.ts.client, 14, 1, 2, self.composite, self.formula)
+        tiles.algebra(self.ts.client, 14, 1, 2, self.composite, self.formula)
+        self.assertEqual(get.call_count, 2)
+
+    def test_eviction(self):
+        cache = TileCache(self.tmpdir.name, max_size=25)
+        cache.set(cache.key(1), b'0123456789')
+        cache.set(cache.key(2), b'0123456789')
+        # Make sure the first tile is the most recently used one.
+        os.utime(cache._path(cache.key(2)), (0, 0))
+        self.assertEqual(cache.get(cache.key(1)), b'0123456789')
+        cache.set(cache.key(3), b'0123456789')
+        self.assertIsNone(cache.get(cache.key(2)))
+        self.assertEqual(cache.get(cache.key(1)), b'0123456789')
+        self.assertEqual(cache.get(cache.key(3)), b'0123456789')
+        self.assertEqual(cache.stats['evictions'], 1)
+
+    def test_eviction_low_water(self):
+        cache = TileCache(self.tmpdir.name, max_size=100, low_water=0.5)
+        with mock.patch.object(cache, 'evict', wraps=cache.evict) as evict:
+            for index in range(30):
+                cache.set(cache.key(index), b'0123456789')
+        # Every eviction pass frees half of the cache.
+        self.assertEqual(evict.call_count, 4)
+        self.assertLessEqual(cache._size, 100)
@@ -0,0 +1,83 @@
+import os
+import re
+import unittest
+
+import mock
+import numpy
+from raster.tiles.utils import tile_bounds
+
+from tesselate import Tesselate
+from tests.test_export import mock_get_algebra
+from tests.utils import TesselateMockResponseBase, tile_coords, tile_value
+
+
+def mock_get_timeseries(session, url):
+    # The second composite has no data for tile 486/392.
+    if re.search(r'algebra/10/486/392\.tif.*B4=3', url):
+
+        class MockResponse(TesselateMockResponseBase):
+            content = b'not a tile'
+
+        return MockResponse()
+
+    return mock_get_algebra(session, url)
+
+
+class TestTesselateTimeseries(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['TESSELO_ACCESS_TOKEN'] = 'tesselate test token env'
+        self.ts = Tesselate()
+        self.composites = [
+            {'id': 1, 'name': 'March', 'rasterlayer_lookup': {'B04.jp2': 1, 'B08.jp2': 2}},
+            {'id': 2, 'name': 'April', 'rasterlayer_lookup': {'B04.jp2': 3, 'B08.jp2': 4}},
+        ]
+        self.formula = {'id': 1, 'name': 'NDVI', 'acronym': 'NDVI', 'formula': '(B8 - B4) / (B8 + B4)'}
+
+    def test_timeseries_points(self):
+        pixels = [(485, 391, 3, 5), (486, 392, 200, 7), (485, 391, 255, 0)]
+        coords = [tile_coords(*pixel) for pixel in pixels]
+        with mock.patch('tesselate.client.requests.Session.get', autospec=True, side_effect=mock_get_timeseries) as get:
+            result = self.ts.timeseries(self.composites, self.formula, coords=coords, zoom=10, workers=3)
+        # Every tile is requested once per composite.
+        self.assertEqual(get.call_count, 4)
+        self.assertEqual(result.shape, (3, 2))
+        numpy.testing.assert_array_equal(result[:, 0], [tile_value(*pixel) for pixel in pixels])
+        numpy.testing.assert_array_equal(result[:, 1], [tile_value(*pixels[0]), numpy.nan, tile_value(*pixels[2])])
+
+    def test_timeseries_areas(self):
+        # Left half of one tile, and a box covering two full tiles.
+        bounds = tile_bounds(485, 391, 10)
+        half = (bounds[0] + 1, bounds[1] + 1, (bounds[0] + bounds[2]) / 2, bounds[3] - 1)
+        other = tile_bounds(486, 392, 10)
+        full = (other[0] + 1, other[1] + 1, other[2] + (other[2] - other[0]) - 1, other[3] - 1)
+        areas = [
+            {'id': 1, 'geom': 'SRID=3857;POLYGON(({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))'.format(*half)},
+            {'id': 2, 'geom': 'SRID=3857;POLYGON(({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))'.format(*full)},
+        ]
+        with mock.patch('tesselate.client.requests.Session.get', autospec=True, side_effect=mock_get_timeseries) as get:
+            result = self.ts.timeseries(self.composites, self.formula, areas=areas, zoom=10)
+        self.assertEqual(result.shape, (2, 2))
+        # The tile requests of both areas are planned together.
+        urls = [call[0][1] for call in get.call_args_list]
+        self.assertEqual(len(urls), len(set(urls)))
+        # Mean of the left half of the tile.
+        data = numpy.arange(256 * 256, dtype='float64').reshape(256, 256)
+        expected = data[:, :128].mean() + 485 * 1e5 + 391 * 1e3
+        numpy.testing.assert_allclose(result[0], [expected, expected])
+        # Mean over two full tiles, only one tile has data in the second date.
+        both = numpy.concatenate([data.ravel() + 486 * 1e5 + 392 * 1e3, data.ravel() + 487 * 1e5 + 392 * 1e3])
+        numpy.testing.assert_allclose(result[1], [both.mean(), data.mean() + 487 * 1e5 + 392 * 1e3])
+
+    def test_timeseries_tile_aligned_area(self):
+        areas = [{'id': 1, 'geom': 'SRID=3857;POLYGON(({0} {1}, {2} {1}, {2} {3}, {0} {3}, {0} {1}))'.format(*tile_bounds(485, 391, 10))}]
+        with mock.patch('tesselate.client.requests.Session.get', autospec=True, side_effect=mock_get_timeseries) as get:
+            result = self.ts.timeseries(self.composites, self.formula, areas=areas, zoom=10)
+        # Neighbouring tiles that only touch the area are not fetched.
+        self.assertEqual(get.call_count, 2)
+        expected = numpy.arange(256 * 256, dtype='float64').mean() + 485 * 1e5 + 391 * 1e3
+        numpy.testing.assert_allclose(result[0], [expected, expected])
+
+    def test_timeseries_locations(self):
+        with self.assertRaises(ValueError):
+            self.ts.timeseries(self.composites, self.formula, zoom=10)
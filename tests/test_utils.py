@@ -1,8 +1,37 @@
+import os
+import time
 import unittest
+from urllib.parse import parse_qs, urlparse
 
 import mock
 
-from tesselate.utils import confirm, layers_dict, layers_query_arg, z_scores_grouping
+from tesselate import Tesselate
+from tesselate.utils import (
+    concurrent_map, confirm, layers_dict, layers_query_arg, populate_aggregation_areas, z_scores_grouping
+)
+from tests.utils import TesselateMockResponseBase
+
+
+def mock_get_areas(filter_supported):
+
+    def mock_get(session, url):
+
+        class MockResponse(TesselateMockResponseBase):
+
+            def json(self):
+                parsed = urlparse(url)
+                query = parse_qs(parsed.query)
+                if parsed.path.startswith('/aggregationarea/'):
+                    return {'id': int(parsed.path.split('/')[-1]), 'geom': 'POINT(0 0)'}
+                if filter_supported:
+                    ids = [int(id) for id in query['id__in'][0].split(',')]
+                else:
+                    ids = range(1000)
+                return {'count': len(ids), 'next': None, 'previous': None, 'results': [{'id': id, 'geom': 'POINT(0 0)'} for id in ids]}
+
+        return MockResponse()
+
+    return mock_get
 
 
 class TestTesselateUtils(unittest.TestCase):
@@ -53,3 +82,42 @@ class TestTesselateUtils(unittest.TestCase):
     @mock.patch('builtins.input', lambda: 'no')
     def test_confirm_no(self):
         self.assertFalse(confirm(''))
+
+
+class TestTesselatePopulateAreas(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['TESSELO_ACCESS_TOKEN'] = 'tesselate test token env'
+        self.client = Tesselate().client
+
+    def test_populate_batches(self):
+        region = {'aggregationareas': list(range(10, 0, -1)) + [{'id': 11}]}
+        with mock.patch('tesselate.client.requests.Session.get', autospec=True, side_effect=mock_get_areas(True)) as get:
+            populate_aggregation_areas(self.client, region, batch_size=4, fields=['geom'])
+        self.assertEqual(get.call_count, 3)
+        self.assertIn('fields=id%2Cgeom', get.call_args[0][1])
+        self.assertEqual([area['id'] for area in region['aggregationareas']], list(range(10, 0, -1)) + [11])
+
+    def test_populate_filter_not_supported(self):
+        region = {'aggregationareas': list(range(10))}
+        with mock.patch('tesselate.client.requests.Session.get', autospec=True, side_effect=mock_get_areas(False)) as get:
+            populate_aggregation_areas(self.client, region, batch_size=4, workers=3)
+        # One list request, then one request per area that was not listed.
+        self.assertEqual(get.call_count, 7)
+        self.assertEqual([area['id'] for area in region['aggregationareas']], list(range(10)))
+
+
+class TestTesselateConcurrentMap(unittest.TestCase):
+
+    def slow(self, value):
+        # Earlier items take longer.
+        time.sleep((5 - value) * 0.01)
+        return value * 2
+
+    def test_concurrent_map_ordered(self):
+        self.assertEqual(list(concurrent_map(self.slow, range(5), workers=4)), [0, 2, 4, 6, 8])
+
+    def test_concurrent_map_unordered(self):
+        result = list(concurrent_map(self.slow, range(5), workers=4, ordered=False))
+        self.assertEqual(sorted(result), [0, 2, 4, 6, 8])
+        self.assertNotEqual(result, [0, 2, 4, 6, 8])
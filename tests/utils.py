@@ -1,3 +1,8 @@
+import numpy
+import requests
+from raster.tiles.utils import tile_bounds, tile_scale
+
+
 class TesselateMockResponseBase(object):
 
     def json(self):
@@ -9,3 +14,25 @@ class TesselateMockResponseBase(object):
     @property
     def content(self):
         return self.json()
+
+
+def response(status, content=b'{}', headers=None):
+    # Real response object, to test status handling and headers.
+    result = requests.Response()
+    result.status_code = status
+    result._content = content
+    result.headers.update(headers or {})
+    result.url = 'https://api.tesselo.com/formula'
+    return result
+
+
+def tile_coords(tilex, tiley, row, col, zoom=10):
+    # Coordinate at the center of a pixel of a tile.
+    bounds = tile_bounds(tilex, tiley, zoom)
+    scale = tile_scale(zoom)
+    return (bounds[0] + (col + 0.5) * scale, bounds[3] - (row + 0.5) * scale)
+
+
+def tile_value(tilex, tiley, row, col):
+    # Pixel value of the mock algebra tiles.
+    return numpy.float32(row * 256 + col + tilex * 1e5 + tiley * 1e3)